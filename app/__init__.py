@@ -1,6 +1,8 @@
 from . import config
 from . import model
 from . import api
+from . import auth
+from . import bulk
 
 from flask import Flask
 import os
@@ -19,6 +21,8 @@ def create_app(config_class='Production', instance_path=None):
 
     model.init_app(app)
     api.init_app(app)
+    auth.init_app(app)
+    bulk.init_app(app)
 
     @app.route('/')
     @app.route('/<path:path>')
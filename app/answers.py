@@ -0,0 +1,130 @@
+from . import cache
+from . import jobs
+from . import model
+from . import stats
+from . import workers
+
+from flask import current_app
+import sqlalchemy.exc
+
+
+keys = cache.LRUCache()
+
+def answer_keys(lecture_id):
+    # Questions never change after creation, so grading a lecture's answers
+    # only needs them loaded once.
+    ret = keys.get(lecture_id)
+    if ret is None:
+        ret = {number: answer_key(q) for number, q in model.questions_by_number(lecture_id, answers=True).items()}
+        keys.set(lecture_id, ret)
+    return ret
+
+def answer_key(question):
+    if question.type == model.QuestionType.multiple_choice:
+        return (question.type, question.multiple_choice_question[0].correct_answer, len(question.multiple_choice_question_variants))
+    elif question.type == model.QuestionType.multiple_select:
+        variants = question.multiple_select_question_variants
+        return (question.type, frozenset(v.number for v in variants if v.correct), len(variants))
+    elif question.type == model.QuestionType.free_response:
+        return (question.type, question.free_response_question[0].correct_answer, question.free_response_question[0].checker)
+
+def grade(key, response):
+    # Returns the response as stored and whether it is correct, or None if
+    # it doesn't answer the question. Multiple choice answers are a variant
+    # number, multiple select answers are comma separated variant numbers.
+    type = key[0]
+    if type == model.QuestionType.free_response:
+        correct_answer, checker = key[1:]
+        if checker == model.FreeResponseQuestionChecker.exact_match:
+            return response, response == correct_answer
+    try:
+        numbers = [int(i) for i in response.split(',')] if response else []
+    except ValueError:
+        return None
+    if not all(0 <= i < key[2] for i in numbers):
+        return None
+    if type == model.QuestionType.multiple_choice:
+        if len(numbers) != 1:
+            return None
+        return str(numbers[0]), numbers[0] == key[1]
+    elif type == model.QuestionType.multiple_select:
+        numbers = sorted(set(numbers))
+        return ','.join(str(i) for i in numbers), frozenset(numbers) == key[1]
+
+
+class Submission(object):
+    def __init__(self, row):
+        self.row = row
+        self.durable = False
+        self.done = jobs.event()
+
+
+queue = []
+lock = workers.native_threading.Lock()
+scheduled = False
+
+def submit(started_lecture_id, question_number, user_id, response, correct):
+    # Queues the answer for the next batch and waits until that batch is
+    # committed. A later answer to the same question replaces the earlier.
+    global scheduled
+    delay = current_app.config['ANSWER_COMMIT_DELAY']
+    submission = Submission({
+        'started_lecture_id': started_lecture_id,
+        'question_number': question_number,
+        'user_id': user_id,
+        'response': response,
+        'correct': correct,
+    })
+    with lock:
+        if len(queue) >= current_app.config['ANSWER_QUEUE_SIZE']:
+            raise workers.Busy
+        queue.append(submission)
+        full = len(queue) >= current_app.config['ANSWER_BATCH_SIZE']
+        start = not full and bool(delay) and not scheduled
+        if start:
+            scheduled = True
+    if full or not delay:
+        flush()
+    elif start:
+        jobs.later(delay, flush)
+    submission.done.wait()
+    return submission.durable
+
+insert_statement = model.QuestionResponse.__table__.insert().prefix_with('OR REPLACE')
+
+def write(engine, rows):
+    with engine.begin() as connection:
+        connection.execute(insert_statement, rows)
+
+def flush():
+    global scheduled
+    with lock:
+        batch = queue[:]
+        queue.clear()
+        scheduled = False
+    if not batch:
+        return
+    try:
+        with stats.timer('answer_batch'):
+            workers.database.run(write, model.db.engine, [s.row for s in batch])
+    except sqlalchemy.exc.IntegrityError:
+        # A row can go bad on its own, e.g. for a lecture deleted since it
+        # was queued; the rest of the batch is written one row at a time.
+        for s in batch:
+            try:
+                workers.database.resume(write, model.db.engine, [s.row])
+            except sqlalchemy.exc.IntegrityError:
+                current_app.logger.warning('dropped an answer to started lecture %d', s.row['started_lecture_id'])
+            except Exception:
+                current_app.logger.exception('failed to write answers')
+                break
+            else:
+                s.durable = True
+    except Exception:
+        current_app.logger.exception('failed to write %d answers', len(batch))
+    else:
+        for s in batch:
+            s.durable = True
+    finally:
+        for s in batch:
+            s.done.set()
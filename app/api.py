@@ -1,12 +1,23 @@
+from . import answers
+from . import auth
+from . import bulk
+from . import cache
+from . import jobs
+from . import journal
+from . import live
 from . import model
 from . import resources
+from . import stats
+from . import workers
 
 from datetime import datetime
-from flask import Blueprint, request, jsonify, url_for
+from flask import Blueprint, Response, copy_current_request_context, current_app, request, jsonify, stream_with_context, url_for
 from flask import session as flask_session
 from flask_socketio import SocketIO, send, emit, join_room, leave_room
+from socketio import packet
+import socketio as python_socketio
 import functools
-import jsonschema
+import itertools
 import secrets
 
 
@@ -22,12 +33,43 @@ class NotFound(Exception):
 
 class Unauthorized(Exception): pass
 
+class BadRequest(Exception): pass
+
 class Forbidden(Exception): pass
 
 
 bp = Blueprint('api', __name__)
 bp_schemas = Blueprint('api_schemas', __name__)
 
+response_samples = itertools.count()
+
+def validate_response(validator, rs):
+    mode = current_app.config['RESPONSE_VALIDATION']
+    if mode == 'off':
+        return
+    if mode == 'sampled' and next(response_samples) % current_app.config['RESPONSE_VALIDATION_SAMPLE'] != 0:
+        return
+    with stats.timer('response_validation'):
+        validator.validate(rs)
+
+def validate_request(check, rq):
+    with stats.timer('request_validation'):
+        return check(rq)
+
+def pooled_items(items, session):
+    # The cursor belongs to a connection used from the database pool, so
+    # the hub pulls the items through the pool a batch at a time.
+    items = iter(items)
+    size = current_app.config['STREAM_BATCH_SIZE']
+    try:
+        while True:
+            batch = workers.database.resume(lambda: list(itertools.islice(items, size)))
+            if not batch:
+                return
+            yield from batch
+    finally:
+        workers.database.resume(session.close)
+
 def handler(view=None, *, method=None, route=None, request_schema=None, response_schema=None, authorized=True):
     if view is None:
         return functools.partial(handler, route=route, method=method, request_schema=request_schema, response_schema=response_schema, authorized=authorized)
@@ -35,6 +77,7 @@ def handler(view=None, *, method=None, route=None, request_schema=None, response
     if request_schema is not None:
         request_schema_view_route = view.__name__ + '_request_schema'
         request_schema['$schema'] = 'http://json-schema.org/schema#'
+        request_checker = resources.schema_checker(request_schema)
         @bp_schemas.route('/' + request_schema_view_route, methods=['GET'], endpoint=request_schema_view_route)
         def request_schema_view():
             request_schema['$id'] = request.url_root[:-1] + url_for('api_schemas.' + request_schema_view_route)
@@ -43,41 +86,73 @@ def handler(view=None, *, method=None, route=None, request_schema=None, response
     if response_schema:
         response_schema_view_route = view.__name__ + '_response_schema'
         response_schema['$schema'] = 'http://json-schema.org/schema#'
+        response_validator = resources.schema_validator(response_schema)
         @bp_schemas.route('/' + response_schema_view_route, methods=['GET'], endpoint=response_schema_view_route)
         def response_schema_view():
             response_schema['$id'] = request.url_root[:-1] + url_for('api_schemas.' + response_schema_view_route)
             return jsonify(response_schema)
 
-    @bp.route(route, methods=[method])
-    @functools.wraps(view)
-    def wrapper(**kwargs):
+    def call_view(**kwargs):
+        if method == 'GET':
+            model.use_reader()
+
         if authorized:
-            session_id = request.headers.get('Authorization')
-            session = model.Session.query.filter_by(id=session_id).one_or_none()
-            if session is None:
-                return jsonify({'status': 'error', 'error': 'unauthorized'}), 401
-            kwargs['user'] = session.user
+            user = auth.authenticate(request.headers.get('Authorization'))
+            if user is None:
+                raise Unauthorized
+            kwargs['user'] = user
 
         if request_schema is not None:
             rq = request.get_json(silent=True)
-            try:
-                jsonschema.validate(rq, request_schema)
-            except jsonschema.exceptions.ValidationError as e:
-                return jsonify({'status': 'error', 'error': 'bad_request', 'request_schema': request.url_root[:-1] + url_for('api_schemas.' + request_schema_view_route)}), 400
+            if not validate_request(request_checker, rq):
+                raise BadRequest
             kwargs['rq'] = rq
 
         try:
-            model.db.session.execute('PRAGMA foreign_keys = ON;')
             rs = view(**kwargs)
+        finally:
+            deferred = jobs.take_deferred()
+        if isinstance(rs, resources.Stream) and workers.database.size:
+            # The stream takes the session over, the request teardown would
+            # otherwise close it under the cursor.
+            session = model.db.session()
+            model.db.session.registry.clear()
+            rs.items = pooled_items(rs.items, session)
+        return rs, deferred
+
+    @bp.route(route, methods=[method])
+    @functools.wraps(view)
+    def wrapper(**kwargs):
+        try:
+            if workers.database.size:
+                rs, deferred = workers.database.run(copy_current_request_context(call_view), **kwargs)
+            else:
+                rs, deferred = call_view(**kwargs)
+            for run in deferred:
+                jobs.start(run)
+        except Unauthorized as e:
+            return jsonify({'status': 'error', 'error': 'unauthorized'}), 401
+        except BadRequest as e:
+            return jsonify({'status': 'error', 'error': 'bad_request', 'request_schema': request.url_root[:-1] + url_for('api_schemas.' + request_schema_view_route)}), 400
+        except resources.InvalidCursor as e:
+            return jsonify({'status': 'error', 'error': 'bad_request', 'path': '/after'}), 400
         except NotUnique as e:
             return jsonify({'status': 'error', 'error': 'not_unique', 'path': e.path, 'value': e.value}), 400
         except NotFound as e:
             return jsonify({'status': 'error', 'error': 'not_found', 'path': e.path, 'value': e.value}), 404
         except Forbidden as e:
             return jsonify({'status': 'error', 'error': 'forbidden'}), 403
-
-        if response_schema is not None:
-            jsonschema.validate(rs, response_schema)
+        except bulk.InUse as e:
+            return jsonify({'status': 'error', 'error': 'in_use', 'path': '/modules/id', 'value': e.module_ids}), 409
+        except workers.Busy as e:
+            return jsonify({'status': 'error', 'error': 'unavailable'}), 503, {'Retry-After': '1'}
+
+        if isinstance(rs, resources.Stream):
+            rs.fields['status'] = 'ok'
+            rs.fields['$schema'] = request.url_root[:-1] + url_for('api_schemas.' + response_schema_view_route)
+            return Response(stream_with_context(rs.encode(lambda item: validate_response(rs.item_validator, item))), mimetype='application/json')
+        elif response_schema is not None:
+            validate_response(response_validator, rs)
             rs['status'] = 'ok'
             rs['$schema'] = request.url_root[:-1] + url_for('api_schemas.' + response_schema_view_route)
             return jsonify(rs)
@@ -91,6 +166,7 @@ def sio_handler(view=None, *, event=None, request_schema=None):
     if request_schema is not None:
         request_schema_view_route = view.__name__ + '_request_schema'
         request_schema['$schema'] = 'http://json-schema.org/schema#'
+        request_checker = resources.schema_checker(request_schema)
         @bp_schemas.route('/' + request_schema_view_route, methods=['GET'], endpoint=request_schema_view_route)
         def request_schema_view():
             request_schema['$id'] = request.url_root[:-1] + url_for('api_schemas.' + request_schema_view_route)
@@ -98,29 +174,33 @@ def sio_handler(view=None, *, event=None, request_schema=None):
 
     @socketio.on(event)
     @functools.wraps(view)
-    def wrapper(data):
+    def wrapper(data=None):
         flask_session.setdefault('state', 'none')
+        # Events of an authenticated connection may come without a payload.
+        data = {} if data is None else data
+        if type(data) is not dict:
+            send({'status': 'error', 'error': 'bad_request'})
+            return
 
         kwargs = {}
-        session_id = data.get('authorization', '')
-        del data['authorization']
-        session = model.Session.query.filter_by(id=session_id).one_or_none()
-        if session is None:
+        token = data.pop('authorization', '')
+        if token:
+            user = auth.authenticate(token)
+        else:
+            user = auth.authenticate_connection(flask_session.get('auth'))
+        if user is None:
             send({'status': 'error', 'error': 'unauthorized'})
             return
-        kwargs['user'] = session.user
+        kwargs['user'] = user
 
         if request_schema is not None:
             rq = data
-            try:
-                jsonschema.validate(rq, request_schema)
-            except jsonschema.exceptions.ValidationError as e:
+            if not validate_request(request_checker, rq):
                 send({'status': 'error', 'error': 'bad_request'})
                 return
             kwargs['rq'] = rq
 
         try:
-            model.db.session.execute('PRAGMA foreign_keys = ON;')
             rs = view(**kwargs)
         except NotUnique as e:
             send({'status': 'error', 'error': 'not_unique', 'path': e.path, 'value': e.value})
@@ -131,19 +211,56 @@ def sio_handler(view=None, *, event=None, request_schema=None):
         except Forbidden as e:
             send({'status': 'error', 'error': 'forbidden'})
             return
+        except BadRequest as e:
+            send({'status': 'error', 'error': 'bad_request'})
+            return
+        except workers.Busy as e:
+            send({'status': 'error', 'error': 'unavailable'})
+            return
+
+class EncodedPacket(packet.Packet):
+    def encode(self):
+        # Encoded once, however many clients it is sent to.
+        if not hasattr(self, 'encoded'):
+            self.encoded = super().encode()
+        return self.encoded
 
-def sio_send(rs, response_schema=None, **kwargs):
-    if response_schema is not None:
-        jsonschema.validate(rs, response_schema)
+def sio_packet(rs, response_validator=None):
+    if response_validator is not None:
+        validate_response(response_validator, rs)
     rs['status'] = 'ok'
-    send(rs, **kwargs)
+    return EncodedPacket(packet.EVENT, data=['message', rs], namespace=request.namespace)
+
+def sio_direct_send(server):
+    # Sending the encoded packet straight to each participant relies on
+    # internals of python-socketio 4 and its in-memory manager. Anything
+    # else goes through send, which encodes the payload per client again.
+    return python_socketio.__version__.split('.')[0] == '4' \
+        and type(server.manager) is python_socketio.BaseManager \
+        and hasattr(server, '_send_packet')
+
+def sio_send_packet(pkt, room=None):
+    server = socketio.server
+    if not sio_direct_send(server):
+        send(pkt.data[1], room=room)
+        return
+    if room is None:
+        sids = [request.sid]
+    elif room in server.manager.rooms.get(request.namespace, {}):
+        sids = server.manager.get_participants(request.namespace, room)
+    else:
+        sids = []
+    for sid in sids:
+        server._send_packet(sid, pkt)
 
+def is_admin(user):
+    return auth.roles(user).admin
 
 def is_teacher(user, course):
-    return model.db.session.query(model.User).join(model.User.teaches).filter(model.User.id == user.id).filter(model.Course.id == course.id).one_or_none() is not None
+    return course.id in auth.roles(user).teaches
 
 def is_student(user, course):
-    return model.db.session.query(model.User).join(model.User.studies).filter(model.User.id == user.id).filter(model.Course.id == course.id).one_or_none() is not None
+    return course.id in auth.roles(user).studies
 
 
 get_users_id_includes = {
@@ -169,7 +286,7 @@ def get_users_id(user, id):
         u = model.User.query.filter_by(id=id).one_or_none()
     if u is None:
         raise NotFound('/users/id', id)
-    if not (u is user or user.admin):
+    if not (u is user or is_admin(user)):
         raise Forbidden
     return resources.user.to_json(u, get_users_id_includes)
 
@@ -179,7 +296,7 @@ def get_users_id(user, id):
     response_schema=resources.user.paginated_schema(get_users_id_includes)
 )
 def get_users(user):
-    if not user.admin:
+    if not is_admin(user):
         raise Forbidden
     return resources.user.paginated_to_json(model.User.query, get_users_id_includes)
 
@@ -227,10 +344,10 @@ get_sessions_id_includes = {
     response_schema=resources.session.schema(get_sessions_id_includes),
 )
 def get_sessions_id(user, id):
-    s = model.Session.query.filter_by(id=id).one_or_none()
+    s = model.Session.query.options(*resources.session.eager(get_sessions_id_includes)).filter_by(id=id).one_or_none()
     if s is None:
         raise NotFound('/sessions/id', id)
-    if not (s.user is user or user.admin):
+    if not (s.user is user or is_admin(user)):
         raise Forbidden
     return resources.session.to_json(s, get_sessions_id_includes)
 
@@ -240,7 +357,7 @@ def get_sessions_id(user, id):
     response_schema=resources.session.paginated_schema(get_sessions_id_includes),
 )
 def get_sessions(user):
-    if not user.admin:
+    if not is_admin(user):
         raise Forbidden
     return resources.session.paginated_to_json(model.Session.query, get_sessions_id_includes)
 
@@ -259,7 +376,7 @@ def get_courses_id(user, id):
     c = model.Course.query.filter_by(id=id).one_or_none()
     if c is None:
         raise NotFound('/courses/id', id)
-    if not (is_student(user, c) or is_teacher(user, c) or user.admin):
+    if not (is_student(user, c) or is_teacher(user, c) or is_admin(user)):
         raise Forbidden
     return resources.course.to_json(c, get_courses_id_includes)
 
@@ -269,7 +386,7 @@ def get_courses_id(user, id):
     response_schema=resources.course.paginated_schema(get_courses_id_includes),
 )
 def get_courses(user):
-    if not user.admin:
+    if not is_admin(user):
         raise Forbidden
     return resources.course.paginated_to_json(model.Course.query, get_courses_id_includes)
 
@@ -342,10 +459,10 @@ get_modules_id_includes = {
     response_schema=resources.module.schema(get_modules_id_includes),
 )
 def get_modules_id(user, id):
-    m = model.Module.query.filter_by(id=id).one_or_none()
+    m = model.Module.query.options(*resources.module.eager(get_modules_id_includes)).filter_by(id=id).one_or_none()
     if m is None:
         raise NotFound('/modules/id', id)
-    if not (is_teacher(user, m.course) or user.admin):
+    if not (is_teacher(user, m.course) or is_admin(user)):
         raise Forbidden
     return resources.module.to_json(m, get_modules_id_includes)
 
@@ -382,7 +499,7 @@ get_modules_includes = {
     response_schema=resources.module.paginated_schema(get_modules_includes),
 )
 def get_modules(user):
-    if not user.admin:
+    if not is_admin(user):
         raise Forbidden
     return resources.module.paginated_to_json(model.Module.query, get_modules_includes)
 
@@ -401,10 +518,10 @@ get_lectures_id_includes = {
     response_schema=resources.lecture.schema(get_lectures_id_includes),
 )
 def get_lectures_id(user, id):
-    l = model.Lecture.query.filter_by(id=id).one_or_none()
+    l = model.Lecture.query.options(*resources.lecture.eager(get_lectures_id_includes)).filter_by(id=id).one_or_none()
     if l is None:
         raise NotFound('/lectures/id', id)
-    if not (is_teacher(user, l.course) or user.admin):
+    if not (is_teacher(user, l.course) or is_admin(user)):
         raise Forbidden
     return resources.lecture.to_json(l, get_lectures_id_includes)
 
@@ -422,7 +539,7 @@ get_lectures_includes = {
     response_schema=resources.lecture.paginated_schema(get_lectures_includes),
 )
 def get_lectures(user):
-    if not user.admin:
+    if not is_admin(user):
         raise Forbidden
     return resources.lecture.paginated_to_json(model.Lecture.query, get_lectures_includes)
 
@@ -467,10 +584,10 @@ get_lectures_id_student_includes = {
     response_schema=resources.lecture.schema(get_lectures_id_student_includes),
 )
 def get_lectures_id_student(user, id):
-    l = model.Lecture.query.filter_by(id=id).one_or_none()
+    l = model.Lecture.query.options(*resources.lecture.eager(get_lectures_id_student_includes)).filter_by(id=id).one_or_none()
     if l is None:
         raise NotFound('/lectures/id', id)
-    if not (is_student(user, l.course) or is_teacher(user, l.course) or user.admin):
+    if not (is_student(user, l.course) or is_teacher(user, l.course) or is_admin(user)):
         raise Forbidden
     return resources.lecture.to_json(l, get_lectures_id_student_includes)
 
@@ -490,10 +607,10 @@ get_started_lectures_id_includes = {
     response_schema=resources.started_lecture.schema(get_started_lectures_id_includes),
 )
 def get_started_lectures_id(user, id):
-    s = model.StartedLecture.query.filter_by(id=id).one_or_none()
+    s = model.StartedLecture.query.options(*resources.started_lecture.eager(get_started_lectures_id_includes)).filter_by(id=id).one_or_none()
     if s is None:
         raise NotFound('/started_lectures/id', id)
-    if not (is_teacher(user, s.lecture.course) or user.admin):
+    if not (is_teacher(user, s.lecture.course) or is_admin(user)):
         raise Forbidden
     return resources.started_lecture.to_json(s, get_started_lectures_id_includes)
 
@@ -511,7 +628,7 @@ get_started_lectures_includes = {
     response_schema=resources.started_lecture.paginated_schema(get_started_lectures_includes),
 )
 def get_started_lectures(user):
-    if not user.admin:
+    if not is_admin(user):
         raise Forbidden
     return resources.started_lecture.paginated_to_json(model.StartedLecture.query, get_started_lectures_includes)
 
@@ -589,10 +706,10 @@ get_started_lectures_id_student_includes = {
     response_schema=resources.started_lecture.schema(get_started_lectures_id_student_includes),
 )
 def get_started_lectures_id_student(user):
-    s = model.StartedLecture.query.filter_by(id=id).one_or_none()
+    s = model.StartedLecture.query.options(*resources.started_lecture.eager(get_started_lectures_id_student_includes)).filter_by(id=id).one_or_none()
     if s is None:
         raise NotFound('/started_lectures/id', id)
-    if not (is_student(user, s.lecture.course) or is_teacher(user, s.lecture.course) or user.admin):
+    if not (is_student(user, s.lecture.course) or is_teacher(user, s.lecture.course) or is_admin(user)):
         raise Forbidden
     return resources.started_lecture.to_json(s, get_started_lectures_id_student_includes)
 
@@ -601,6 +718,17 @@ get_users_id_sessions_includes = {
     'id': {},
 }
 
+@handler(
+    method='GET',
+    route='/stats',
+    response_schema={'type': 'object', 'properties': {'counters': {'type': 'object', 'additionalProperties': {'type': 'number'}}}, 'required': ['counters']},
+)
+def get_stats(user):
+    if not is_admin(user):
+        raise Forbidden
+    return {'counters': stats.snapshot()}
+
+
 @handler(
     method='GET',
     route='/users/<id>/sessions',
@@ -613,7 +741,7 @@ def get_users_id_sessions(user, id):
         u = model.User.query.filter_by(id=id).one_or_none()
     if u is None:
         raise NotFound('/users/id', id)
-    if not (user is u or user.admin):
+    if not (user is u or is_admin(user)):
         raise Forbidden
     return resources.session.paginated_to_json(model.Session.query.filter(model.Session.user_id == u.id), get_users_id_sessions_includes)
 
@@ -629,7 +757,7 @@ def get_users_id_courses(user, id):
         u = model.User.query.filter_by(id=id).one_or_none()
     if u is None:
         raise NotFound('/users/id', id)
-    if user.admin:
+    if is_admin(user):
         return resources.course.paginated_to_json(model.Course.query, get_courses_id_includes)
     elif user is u:
         return resources.course.paginated_to_json(
@@ -656,7 +784,7 @@ def get_users_id_teaches(user, id):
         u = model.User.query.filter_by(id=id).one_or_none()
     if u is None:
         raise NotFound('/users/id', id)
-    if not (user is u or user.admin):
+    if not (user is u or is_admin(user)):
         raise Forbidden
     return resources.course.paginated_to_json(model.Course.query.join(model.Course.teachers).filter(model.User.id == u.id), get_courses_id_includes)
 
@@ -672,7 +800,7 @@ def get_users_id_studies(user, id):
         u = model.User.query.filter_by(id=id).one_or_none()
     if u is None:
         raise NotFound('/users/id', id)
-    if not (user is u or user.admin):
+    if not (user is u or is_admin(user)):
         raise Forbidden
     return resources.course.paginated_to_json(model.Course.query.join(model.Course.students).filter(model.User.id == u.id), get_courses_id_includes)
 
@@ -695,7 +823,7 @@ def get_users_id_lectures(user, id):
         u = model.User.query.filter_by(id=id).one_or_none()
     if u is None:
         raise NotFound('/users/id', id)
-    if user.admin:
+    if is_admin(user):
         return resources.lecture.paginated_to_json(model.Lecture.query, get_lectures_includes)
     elif user is u:
         return resources.lecture.paginated_to_json(
@@ -724,7 +852,7 @@ def get_users_id_created_lectures(user, id):
         u = model.User.query.filter_by(id=id).one_or_none()
     if u is None:
         raise NotFound('/users/id', id)
-    if not (user is u or user.admin):
+    if not (user is u or is_admin(user)):
         raise Forbidden
     return resources.course.paginated_to_json(model.Lecture.query.join(model.Lecure.author).filter(model.User.id == u.id), get_users_id_created_lectures_includes)
 
@@ -740,7 +868,7 @@ def get_users_id_modules(user, id):
         u = model.User.query.filter_by(id=id).one_or_none()
     if u is None:
         raise NotFound('/users/id', id)
-    if user.admin:
+    if is_admin(user):
         return resources.module.paginated_to_json(model.Module.query, get_modules_includes)
     elif user is u:
         return resources.module.paginated_to_json(
@@ -793,7 +921,7 @@ def get_users_id_created_modules(user, id):
         u = model.User.query.filter_by(id=id).one_or_none()
     if u is None:
         raise NotFound('/users/id', id)
-    if not (user is u or user.admin):
+    if not (user is u or is_admin(user)):
         raise Forbidden
     return resources.course.paginated_to_json(model.Module.query.join(model.Module.author).filter(model.User.id == u.id), get_users_id_created_modules_includes)
 
@@ -816,7 +944,7 @@ def get_users_id_started_lectures(user, id):
         u = model.User.query.filter_by(id=id).one_or_none()
     if u is None:
         raise NotFound('/users/id', id)
-    if not (user is u or user.admin):
+    if not (user is u or is_admin(user)):
         raise Forbidden
     return resources.started_lecture.paginated_to_json(model.StartedLecture.query.join(model.StartedLecture.lecturer).filter(model.User.id == u.id), get_users_id_started_lectures_includes)
 
@@ -838,10 +966,10 @@ def get_users_id_active_lectures(user, id):
         u = model.User.query.filter_by(id=id).one_or_none()
     if u is None:
         raise NotFound('/users/id', id)
-    if not (user is u or user.admin):
+    if not (user is u or is_admin(user)):
         raise Forbidden
 
-    if user.admin:
+    if is_admin(user):
         return resources.started_lecture.paginated_to_json(model.StartedLecture.query, get_users_id_active_lectures_includes)
     else:
         return resources.started_lecture.paginated_to_json(
@@ -863,9 +991,9 @@ def get_users_id_creatable_courses(user, id):
         u = model.User.query.filter_by(id=id).one_or_none()
     if u is None:
         raise NotFound('/users/id', id)
-    if not (user is u or user.admin):
+    if not (user is u or is_admin(user)):
         raise Forbidden
-    if user.admin:
+    if is_admin(user):
         query = model.Course.query
     else:
         query = model.Course.query.join(model.Course.teachers).filter(model.User.id == u.id)
@@ -880,7 +1008,7 @@ def get_courses_id_teachers(user, id):
     c = model.Course.query.filter_by(id=id).one_or_none()
     if c is None:
         raise NotFound('/courses/id', id)
-    if not (is_student(user, c) or is_teacher(user, c) or user.admin):
+    if not (is_student(user, c) or is_teacher(user, c) or is_admin(user)):
         raise Forbidden
     return resources.user.paginated_to_json(model.User.query.join(model.User.teaches).filter(model.Course.id == c.id), get_users_id_public_includes)
 
@@ -893,7 +1021,7 @@ def get_courses_id_students(user, id):
     c = model.Course.query.filter_by(id=id).one_or_none()
     if c is None:
         raise NotFound('/courses/id', id)
-    if not (is_student(user, c) or is_teacher(user, c) or user.admin):
+    if not (is_student(user, c) or is_teacher(user, c) or is_admin(user)):
         raise Forbidden
     return resources.user.paginated_to_json(model.User.query.join(model.User.students).filter(model.Course.id == c.id), get_users_id_public_includes)
 
@@ -910,12 +1038,36 @@ get_started_lectures_id_responses_includes = {
 )
 def get_started_lectures_id_responses(user, id):
     s = model.StartedLecture.query.filter_by(id=id).one_or_none()
-    if c is None:
+    if s is None:
         raise NotFound('/started_lectures/id', id)
-    if not (s.lecturer is user or user.admin):
+    if not (s.lecturer is user or is_admin(user)):
         raise Forbidden
     return resources.question_response.paginated_to_json(model.QuestionResponse.query.filter(model.QuestionResponse.started_lecture_id == s.id), get_started_lectures_id_responses_includes)
 
+get_started_lectures_id_events_includes = {
+    'id': {},
+    'created_at': {},
+    'kind': {},
+    'user_id': {},
+    'module_number': {},
+    'module_started': {},
+    'question_number': {},
+    'response': {},
+}
+
+@handler(
+    method='GET',
+    route='/started_lectures/<id>/events',
+    response_schema=resources.lecture_event.paginated_schema(get_started_lectures_id_events_includes),
+)
+def get_started_lectures_id_events(user, id):
+    s = model.StartedLecture.query.filter_by(id=id).one_or_none()
+    if s is None:
+        raise NotFound('/started_lectures/id', id)
+    if not (s.lecturer is user or is_admin(user)):
+        raise Forbidden
+    return resources.lecture_event.paginated_to_json(journal.replay(s.id), get_started_lectures_id_events_includes)
+
 post_users_includes = {
     'first_name': {},
     'last_name': {},
@@ -943,11 +1095,22 @@ def post_users(rq):
         university = rq['university'],
         university_group = rq['university_group'],
         email = rq['email'],
-        password = rq['password'],
+        password_hash = workers.hash_password(rq['password']),
     )
     model.db.session.add(u)
     model.db.session.commit()
 
+@handler(
+    method='POST',
+    route='/users/import',
+    response_schema=bulk.import_report_schema,
+)
+def post_users_import(user):
+    if not is_admin(user):
+        raise Forbidden
+    format = 'csv' if request.mimetype == 'text/csv' else 'jsonl'
+    return bulk.import_users(bulk.read_rows(request.stream, format), current_app.config['IMPORT_CHUNK_SIZE'])
+
 patch_users_id_includes = {
     'first_name': {},
     'last_name': {},
@@ -968,7 +1131,7 @@ def patch_users_id(user, id, rq):
         u = model.User.query.filter_by(id=id).one_or_none()
     if u is None:
         raise NotFound('/users/id', id)
-    if not (u is user or user.admin):
+    if not (u is user or is_admin(user)):
         raise Forbidden
 
     u.first_name = rq['first_name']
@@ -978,6 +1141,9 @@ def patch_users_id(user, id, rq):
     u.university_group = rq['university_group']
 
     model.db.session.commit()
+    auth.forget_user(u.id)
+    # Lecturers' and authors' names are part of the broadcast packets.
+    broadcasts.clear()
 
 post_sessions_user_includes = {
     'email': {},
@@ -995,14 +1161,21 @@ def post_sessions(rq):
     u = model.User.query.filter_by(email=rq['email']).one_or_none()
     if u is None:
         raise NotFound('/users/email', rq['email'])
-    if not u.check_password(rq['password']):
+    if not workers.check_password(u.password, rq['password']):
         raise Forbidden
 
+    if current_app.config['AUTH_BACKEND'] == 'signed':
+        auth.revoke_tokens(u)
+        model.db.session.commit()
+        s = model.Session(id=auth.issue_token(u), user=u)
+        return resources.session.to_json(s, get_sessions_id_includes)
+
     model.Session.query.filter_by(user_id=u.id).delete()
     s = model.Session(id=secrets.token_hex(16), user=u)
 
     model.db.session.add(s)
     model.db.session.commit()
+    auth.forget_sessions(u.id)
 
     return resources.session.to_json(s, get_sessions_id_includes)
 
@@ -1018,7 +1191,7 @@ post_courses_includes = {
 def post_courses(user, rq):
     if model.Course.query.filter_by(title=rq['title']).one_or_none() is not None:
         raise NotUnique('/courses/title', rq['title'])
-    if not user.admin:
+    if not is_admin(user):
         raise Forbidden
 
     c = model.Course(title=rq['title'])
@@ -1029,16 +1202,47 @@ def post_courses(user, rq):
 @handler(
     method='DELETE',
     route='/courses/<id>',
+    response_schema={
+        'type': 'object',
+        'properties': {
+            'job': jobs.job_schema,
+        },
+    },
 )
 def delete_courses_id(user, id):
     c = model.Course.query.filter_by(id=id).one_or_none()
     if c is None:
         raise NotFound('/courses/id', id)
-    if not user.admin:
+    if not is_admin(user):
         raise Forbidden
 
-    model.db.session.delete(c)
-    model.db.session.commit()
+    shared = bulk.shared_modules(c.id)
+    if shared:
+        raise bulk.InUse(shared)
+
+    if request.args.get('background') == 'true':
+        return {'job': jobs.submit('delete_course', 0, bulk.delete_course_job(c.id)).to_json()}
+    bulk.delete_course(c.id)
+    return {}
+
+@handler(
+    method='GET',
+    route='/jobs/<id>',
+    response_schema={
+        'type': 'object',
+        'properties': {
+            'job': jobs.job_schema,
+        },
+        'required': ['job'],
+    },
+)
+def get_jobs_id(user, id):
+    if not is_admin(user):
+        raise Forbidden
+    job = jobs.get(id)
+    if job is None:
+        raise NotFound('/jobs/id', id)
+    return {'job': job.to_json()}
 
 post_modules_question_includes = {
     model.QuestionType.multiple_choice: {
@@ -1060,19 +1264,17 @@ post_modules_question_includes = {
     },
 }
 
-def question_from_json(rq):
-    ret = model.Question(type=getattr(model.QuestionType, rq['type']))
-    model.db.session.add(ret)
+def question_from_json(plan, rq):
+    ret = plan.insert(model.Question.__table__, type=getattr(model.QuestionType, rq['type']))
     if rq['type'] == 'multiple_choice':
-        q = model.MultipleChoiceQuestion(question=ret, correct_answer=rq['correct_answer'])
-        model.db.session.add(q)
+        plan.add(model.MultipleChoiceQuestion.__table__, question_id=ret, correct_answer=rq['correct_answer'])
         for number, text in enumerate(rq['variants']):
-            model.db.session.add(model.MultipleChoiceQuestionVariant(number=number, text=text, question=ret))
+            plan.add(model.MultipleChoiceQuestionVariant.__table__, question_id=ret, number=number, text=text)
     elif rq['type'] == 'multiple_select':
         for number, var in enumerate(rq['variants']):
-            model.db.session.add(model.MultipleSelectQuestionVariant(number=number, text=var['text'], correct=var['correct'], question=ret))
+            plan.add(model.MultipleSelectQuestionVariant.__table__, question_id=ret, number=number, text=var['text'], correct=var['correct'])
     elif rq['type'] == 'free_response':
-        model.db.session.add(model.FreeResponseQuestion(correct_answer=rq['correct_answer'], checker=getattr(model.FreeResponseQuestionChecker, rq['checker']), question=ret))
+        plan.add(model.FreeResponseQuestion.__table__, question_id=ret, correct_answer=rq['correct_answer'], checker=getattr(model.FreeResponseQuestionChecker, rq['checker']))
     return ret
 
 post_modules_includes = {
@@ -1101,22 +1303,21 @@ post_modules_includes = {
     },
 }
 
-def module_from_json(rq, author, course):
-    ret = model.Module(title=rq['title'], type=getattr(model.ModuleType, rq['type']), created_at=datetime.now(), author=author, course=course)
-    model.db.session.add(ret)
+def module_from_json(plan, rq, author, course, questions=None):
+    has_question = rq['type'] == 'test_block' or (rq['type'] == 'text' and rq['question'] is not None)
+    ret = plan.insert(model.Module.__table__, title=rq['title'], type=getattr(model.ModuleType, rq['type']), created_at=datetime.now(), author_id=author.id, course_id=course.id, has_question=has_question)
     if rq['type'] == 'text':
         q = None
         if rq['question'] is not None:
-            q = question_from_json(rq['question'])
-        model.db.session.add(model.TextModule(text=rq['text'], question=q, module=ret))
+            q = question_from_json(plan, rq['question'])
+            if questions is not None:
+                questions.append(q)
+        plan.add(model.TextModule.__table__, module_id=ret, text=rq['text'], question_id=q)
     elif rq['type'] == 'visual':
         pass
     elif rq['type'] == 'test_block':
         for i, tbm in enumerate(rq['test_block_modules']):
-            m = module_from_json(tbm, author, course)
-            model.db.session.add(m)
-            model.db.session.flush()
-            model.db.session.execute(model.test_block_modules.insert().values(test_block_id=ret.id, number=i, module_id=m.id))
+            plan.add(model.test_block_modules, test_block_id=ret, number=i, module_id=module_from_json(plan, tbm, author, course, questions))
     return ret
 
 @handler(
@@ -1128,10 +1329,12 @@ def post_modules(user, rq):
     c = model.Course.query.filter_by(id=rq['course_id']).one_or_none()
     if c is None:
         raise NotFound('/courses/id', rq['course_id'])
-    if not (user.admin or is_teacher(user, c)):
+    if not (is_admin(user) or is_teacher(user, c)):
         raise Forbidden
 
-    module_from_json(rq, user, c)
+    plan = bulk.Plan(model.db.session)
+    module_from_json(plan, rq, user, c)
+    plan.execute()
     model.db.session.commit()
 
 post_lectures_modules_includes = {
@@ -1163,22 +1366,13 @@ post_lectures_includes = {
     'modules': post_lectures_modules_includes,
 }
 
-def lecture_from_json(rq, author, course):
-    ret = model.Lecture(title=rq['title'], created_at=datetime.now(), author=author, course=course)
-    model.db.session.add(ret)
-    qi = 0
+def lecture_from_json(plan, rq, author, course):
+    ret = plan.insert(model.Lecture.__table__, title=rq['title'], created_at=datetime.now(), author_id=author.id, course_id=course.id)
+    questions = []
     for i, mrq in enumerate(rq['modules']):
-        m = module_from_json(mrq, author, course)
-        model.db.session.add(m)
-        model.db.session.flush()
-        model.db.session.execute(model.lecture_modules.insert().values(lecture_id=ret.id, number=i, module_id=m.id))
-        if m.type == model.ModuleType.text and m.text_module[0].question is not None:
-            model.db.session.execute(model.lecture_questions.insert().values(lecture_id=ret.id, number=qi, question_id=m.text_module[0].question.id))
-            qi += 1
-        elif m.type == model.ModuleType.test_block:
-            for mm in m.test_block_modules:
-                model.db.session.execute(model.lecture_questions.insert().values(lecture_id=ret.id, number=qi, question_id=mm.text_module[0].question.id))
-                qi += 1
+        plan.add(model.lecture_modules, lecture_id=ret, number=i, module_id=module_from_json(plan, mrq, author, course, questions))
+    for i, q in enumerate(questions):
+        plan.add(model.lecture_questions, lecture_id=ret, number=i, question_id=q)
     return ret
 
 @handler(
@@ -1190,10 +1384,12 @@ def post_lectures(user, rq):
     c = model.Course.query.filter_by(id=rq['course_id']).one_or_none()
     if c is None:
         raise NotFound('/courses/id', rq['course_id'])
-    if not (user.admin or is_teacher(user, c)):
+    if not (is_admin(user) or is_teacher(user, c)):
         raise Forbidden
 
-    lecture_from_json(rq, user, c)
+    plan = bulk.Plan(model.db.session)
+    lecture_from_json(plan, rq, user, c)
+    plan.execute()
     model.db.session.commit()
 
 post_started_lectures_includes = {
@@ -1209,23 +1405,55 @@ def post_started_lectures(user, rq):
     l = model.Lecture.query.filter_by(id=rq['lecture_id']).one_or_none()
     if l is None:
         raise NotFound('/lectures/id', rq['lecture_id'])
-    if not (is_teacher(user, l.course) or user.admin):
+    if not (is_teacher(user, l.course) or is_admin(user)):
         raise Forbidden
 
-    cur_mod = l.modules[0]
-    if cur_mod.type == model.ModuleType.text and cur_mod.text_module[0].question is not None:
-        cur_mod_started = False
-    elif cur_mod.type == model.ModuleType.test_block:
-        cur_mod_started = False
-    else:
-        cur_mod_started = None
-    sl = model.StartedLecture(lecture=l, lecturer=user, started_at=datetime.now(), current_module_number=0, current_module_started=cur_mod_started)
+    sl = model.StartedLecture(lecture=l, lecturer=user, started_at=datetime.now(), current_module_number=0, current_module_started=l.playlist[0].initially_started)
     model.db.session.add(sl)
     model.db.session.commit()
 
 
 socketio = SocketIO()
 
+sio_started_lecture_validator = resources.schema_validator(resources.started_lecture.schema(get_started_lectures_id_includes))
+sio_started_lecture_student_validator = resources.schema_validator(resources.started_lecture.schema(get_started_lectures_id_student_includes))
+
+@socketio.on('connect')
+def sio_connect():
+    # Clients that pass their token when connecting don't have to send it
+    # with every event.
+    token = request.args.get('authorization')
+    if token is None:
+        return
+    user = auth.authenticate(token)
+    if user is None:
+        return False
+    flask_session['auth'] = auth.connection_identity(user)
+
+broadcasts = cache.LRUCache()
+
+def sio_started_lecture_packets(s):
+    # What a started lecture looks like only depends on its current module,
+    # so each state is serialized once for the viewing and the presenting
+    # room, and joiners get the same packets.
+    key = (s.id, s.current_module_number, s.current_module_started)
+    ret = broadcasts.get(key)
+    # Ids of deleted started lectures get reused.
+    if ret is None or ret[0] != s.started_at:
+        s = live.instance(s)
+        ret = (
+            s.started_at,
+            sio_packet(resources.started_lecture.to_json(s, get_started_lectures_id_student_includes), sio_started_lecture_student_validator),
+            sio_packet(resources.started_lecture.to_json(s, get_started_lectures_id_includes), sio_started_lecture_validator),
+        )
+        broadcasts.set(key, ret)
+    return ret[1:]
+
+def sio_broadcast_started_lecture(s):
+    viewing, presenting = sio_started_lecture_packets(s)
+    sio_send_packet(viewing, room=f'{s.id}-viewing')
+    sio_send_packet(presenting, room=f'{s.id}-presenting')
+
 sio_join_started_lectures_includes = {
     'id': {}
 }
@@ -1238,17 +1466,22 @@ def sio_join(user, rq):
     if flask_session['state'] != 'none':
         raise Forbidden
 
+    # Goes through the live state first, which picks up transitions only the
+    # journal has, so the overlay serves them.
+    live.get(rq['id'])
     s = model.StartedLecture.query.filter_by(id=rq['id']).one_or_none()
     if s is None:
         raise NotFound('/started_lectures/id', id)
-    if not (is_student(user, s.lecture.course) or is_teacher(user, s.lecture.course) or user.admin):
+    if not (is_student(user, s.lecture.course) or is_teacher(user, s.lecture.course) or is_admin(user)):
         raise Forbidden
 
     flask_session['state'] = 'viewing'
     flask_session['id'] = rq['id']
     join_room(f'{flask_session["id"]}-{flask_session["state"]}')
+    journal.record(s.id, 'join', user.id)
 
-    sio_send(resources.started_lecture.to_json(s, get_started_lectures_id_student_includes), resources.started_lecture.schema(get_started_lectures_id_student_includes))
+    viewing, presenting = sio_started_lecture_packets(s)
+    sio_send_packet(viewing)
 
 @sio_handler(
     event='present',
@@ -1258,17 +1491,22 @@ def sio_present(user, rq):
     if flask_session['state'] != 'none':
         raise Forbidden
 
+    # Goes through the live state first, which picks up transitions only the
+    # journal has, so the overlay serves them.
+    live.get(rq['id'])
     s = model.StartedLecture.query.filter_by(id=rq['id']).one_or_none()
     if s is None:
         raise NotFound('/started_lectures/id', id)
-    if not (is_teacher(user, s.lecture.course) or user.admin):
+    if not (is_teacher(user, s.lecture.course) or is_admin(user)):
         raise Forbidden
 
     flask_session['state'] = 'presenting'
     flask_session['id'] = rq['id']
     join_room(f'{flask_session["id"]}-{flask_session["state"]}')
+    journal.record(s.id, 'present', user.id)
 
-    sio_send(resources.started_lecture.to_json(s, get_started_lectures_id_includes), resources.started_lecture.schema(get_started_lectures_id_includes))
+    viewing, presenting = sio_started_lecture_packets(s)
+    sio_send_packet(presenting)
 
 @sio_handler(
     event='leave',
@@ -1278,6 +1516,7 @@ def sio_leave(user):
         raise Forbidden
 
     leave_room(f'{flask_session["id"]}-{flask_session["state"]}')
+    journal.record(flask_session['id'], 'leave', user.id)
     flask_session['state'] = 'none'
     del flask_session['id']
 
@@ -1288,22 +1527,12 @@ def sio_prev_module(user):
     if flask_session['state'] != 'presenting':
         raise Forbidden
 
-    s = model.StartedLecture.query.filter_by(id=flask_session['id']).one_or_none()
-    if s.current_module_number == 0:
-        raise Forbidden
-
-    s.current_module_number -= 1
-    if s.current_module.type == model.ModuleType.text and s.current_module.text_module[0].question is not None:
-        cur_mod_started = False
-    elif s.current_module.type == model.ModuleType.test_block:
-        cur_mod_started = False
-    else:
-        cur_mod_started = None
-    s.current_module_started = cur_mod_started
-    model.db.session.commit()
-
-    sio_send(resources.started_lecture.to_json(s, get_started_lectures_id_student_includes), resources.started_lecture.schema(get_started_lectures_id_student_includes), room=f'{flask_session["id"]}-viewing')
-    sio_send(resources.started_lecture.to_json(s, get_started_lectures_id_includes), resources.started_lecture.schema(get_started_lectures_id_includes), room=f'{flask_session["id"]}-presenting')
+    def step(s):
+        if s.current_module_number == 0:
+            raise Forbidden
+        s.current_module_number -= 1
+        s.current_module_started = model.playlist(s.lecture_id)[s.current_module_number].initially_started
+    sio_broadcast_started_lecture(live.transition(flask_session['id'], step, user.id))
 
 @sio_handler(
     event='next-module',
@@ -1313,40 +1542,88 @@ def sio_next_module(user):
         print(flask_session['state'])
         raise Forbidden
 
-    s = model.StartedLecture.query.filter_by(id=flask_session['id']).one_or_none()
-    if s.current_module_number + 1 == len(s.lecture.modules):
-        raise Forbidden
-
-    s.current_module_number += 1
-    if s.current_module.type == model.ModuleType.text and s.current_module.text_module[0].question is not None:
-        cur_mod_started = False
-    elif s.current_module.type == model.ModuleType.test_block:
-        cur_mod_started = False
-    else:
-        cur_mod_started = None
-    s.current_module_started = cur_mod_started
-    model.db.session.commit()
-
-    sio_send(resources.started_lecture.to_json(s, get_started_lectures_id_student_includes), resources.started_lecture.schema(get_started_lectures_id_student_includes), room=f'{flask_session["id"]}-viewing')
-    sio_send(resources.started_lecture.to_json(s, get_started_lectures_id_includes), resources.started_lecture.schema(get_started_lectures_id_includes), room=f'{flask_session["id"]}-presenting')
+    def step(s):
+        if s.current_module_number + 1 == len(model.playlist(s.lecture_id)):
+            raise Forbidden
+        s.current_module_number += 1
+        s.current_module_started = model.playlist(s.lecture_id)[s.current_module_number].initially_started
+    sio_broadcast_started_lecture(live.transition(flask_session['id'], step, user.id))
 
 # @socketio.on('stop')
 # def sio_stop(user, rq):
 #     pass
 
-# @socketio.on('start-module')
-# def sio_start_module(user, rq):
-#     pass
+@sio_handler(
+    event='start-module',
+)
+def sio_start_module(user):
+    if flask_session['state'] != 'presenting':
+        raise Forbidden
 
-# @socketio.on('stop-module')
-# def sio_stop_module(user, rq):
-#     pass
+    def step(s):
+        if s.current_module_started is not False:
+            raise Forbidden
+        s.current_module_started = True
+    sio_broadcast_started_lecture(live.transition(flask_session['id'], step, user.id))
 
-# @socketio.on('answer')
-# def sio_answer(user, rq):
-#     pass
+@sio_handler(
+    event='stop-module',
+)
+def sio_stop_module(user):
+    if flask_session['state'] != 'presenting':
+        raise Forbidden
+
+    def step(s):
+        if s.current_module_started is not True:
+            raise Forbidden
+        s.current_module_started = False
+    sio_broadcast_started_lecture(live.transition(flask_session['id'], step, user.id))
+
+sio_answer_includes = {
+    'number': {},
+    'response': {},
+}
+
+@sio_handler(
+    event='answer',
+    request_schema=resources.question_response.schema(sio_answer_includes),
+)
+def sio_answer(user, rq):
+    if flask_session['state'] != 'viewing':
+        raise Forbidden
+
+    s = live.get(flask_session['id'])
+    if s is None:
+        raise NotFound('/started_lectures/id', flask_session['id'])
+    s = s.snapshot()
+    if not (s.current_module_started and rq['number'] in model.playlist(s.lecture_id)[s.current_module_number].question_numbers):
+        raise Forbidden
+    if rq['response'] is None:
+        raise BadRequest
+    graded = answers.grade(answers.answer_keys(s.lecture_id)[rq['number']], rq['response'])
+    if graded is None:
+        raise BadRequest
+
+    response, correct = graded
+    if not answers.submit(s.id, rq['number'], user.id, response, correct):
+        raise workers.Busy
+    journal.record(s.id, 'answer', user.id, question_number=rq['number'], response=response)
+    send({'status': 'ok', 'number': rq['number']})
 
 def init_app(app):
+    resources.serialized.maxsize = app.config['SERIALIZATION_CACHE_SIZE']
+    stats.register('serialization_cache', resources.serialized.stats)
+    stats.register('auth_session_cache', auth.sessions.stats)
+    stats.register('auth_user_cache', auth.users.stats)
+    stats.register('auth_role_cache', auth.role_index.stats)
+    stats.register('playlist_cache', model.playlists.stats)
+    broadcasts.maxsize = app.config['BROADCAST_CACHE_SIZE']
+    stats.register('broadcast_cache', broadcasts.stats)
+    answers.keys.maxsize = app.config['ANSWER_KEY_CACHE_SIZE']
+    stats.register('answer_key_cache', answers.keys.stats)
     socketio.init_app(app)
+    workers.init_app(app, green=socketio.async_mode == 'eventlet')
+    jobs.init_app(app, socketio)
+    live.init_app(app)
     app.register_blueprint(bp, url_prefix='/api')
     app.register_blueprint(bp_schemas, url_prefix='/api-schemas')
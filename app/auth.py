@@ -0,0 +1,150 @@
+from . import cache
+from . import model
+
+from flask import current_app
+import collections
+import itertools
+import itsdangerous
+import sqlalchemy
+import sqlalchemy.orm
+
+
+sessions = cache.LRUCache()
+users = cache.LRUCache()
+role_index = cache.LRUCache()
+revisions = collections.Counter()
+
+Roles = collections.namedtuple('Roles', ['admin', 'teaches', 'studies'])
+
+def authenticate(token):
+    if not token:
+        return None
+    if current_app.config['AUTH_BACKEND'] == 'signed':
+        return authenticate_signed(token)
+    user_id = sessions.get(token)
+    if user_id is None:
+        s = model.Session.query.filter_by(id=token).one_or_none()
+        if s is None:
+            return None
+        user_id = s.user_id
+        sessions.set(token, user_id, ttl=current_app.config['AUTH_CACHE_TTL'])
+    return load_user(user_id)
+
+def serializer():
+    return itsdangerous.URLSafeTimedSerializer(current_app.secret_key, salt='session')
+
+def issue_token(user):
+    return serializer().dumps({'u': user.id, 'g': user.session_generation})
+
+def authenticate_signed(token):
+    # The signature and expiry are checked in-process; the only state needed
+    # is the user's session generation, which comes from the user cache.
+    try:
+        payload = serializer().loads(token, max_age=current_app.config['AUTH_TOKEN_MAX_AGE'])
+    except itsdangerous.BadData:
+        return None
+    u = load_user(payload['u'])
+    if u is None or u.session_generation != payload['g']:
+        return None
+    return u
+
+def revoke_tokens(user):
+    user.session_generation += 1
+    forget_user(user.id)
+    revisions[user.id] += 1
+
+def connection_identity(user):
+    return (user.id, revisions[user.id])
+
+def authenticate_connection(identity):
+    # Socket.IO connections authenticate once; they stay valid until the
+    # user's sessions are replaced or revoked.
+    if identity is None:
+        return None
+    user_id, revision = identity
+    if revisions[user_id] != revision:
+        return None
+    return load_user(user_id)
+
+def load_user(user_id):
+    columns = users.get(user_id)
+    if columns is None:
+        u = model.User.query.options(sqlalchemy.orm.joinedload(model.User.admin_entry)).filter_by(id=user_id).one_or_none()
+        if u is not None:
+            columns = {c.key: getattr(u, c.key) for c in sqlalchemy.inspect(model.User).column_attrs}
+            users.set(user_id, (columns, u.admin), ttl=current_app.config['AUTH_CACHE_TTL'])
+        return u
+    return attach(*columns)
+
+def attach(columns, admin):
+    # Rebuilds the user as if it had just been loaded and merges it into the
+    # current session without emitting a SELECT.
+    u = sqlalchemy.inspect(model.User).class_manager.new_instance()
+    for key, value in columns.items():
+        setattr(u, key, value)
+    if admin:
+        u.admin_entry = model.Admin(user_id=u.id)
+        sqlalchemy.orm.make_transient_to_detached(u.admin_entry)
+    else:
+        u.admin_entry = None
+    sqlalchemy.orm.make_transient_to_detached(u)
+    return model.db.session.merge(u, load=False)
+
+def forget_user(user_id):
+    users.pop(user_id)
+
+def forget_sessions(user_id):
+    sessions.pop_matching(lambda token, value: value == user_id)
+    revisions[user_id] += 1
+
+def roles(user):
+    ret = role_index.get(user.id)
+    if ret is None:
+        ret = load_roles(user.id)
+        role_index.set(user.id, ret, ttl=current_app.config['AUTH_CACHE_TTL'])
+    return ret
+
+def load_roles(user_id):
+    # Admin flag and both course memberships in a single round trip.
+    rows = model.db.session.execute(sqlalchemy.union_all(
+        sqlalchemy.select([sqlalchemy.literal('admin'), model.admins.c.user_id]).where(model.admins.c.user_id == user_id),
+        sqlalchemy.select([sqlalchemy.literal('teaches'), model.teachers.c.course_id]).where(model.teachers.c.user_id == user_id),
+        sqlalchemy.select([sqlalchemy.literal('studies'), model.students.c.course_id]).where(model.students.c.user_id == user_id),
+    )).fetchall()
+    return Roles(
+        admin=any(kind == 'admin' for kind, _ in rows),
+        teaches=frozenset(course_id for kind, course_id in rows if kind == 'teaches'),
+        studies=frozenset(course_id for kind, course_id in rows if kind == 'studies'),
+    )
+
+def forget_roles(user_ids=None):
+    if user_ids is None:
+        role_index.clear()
+        return
+    for user_id in user_ids:
+        role_index.pop(user_id)
+
+@sqlalchemy.event.listens_for(sqlalchemy.orm.Session, 'after_flush')
+def forget_changed_roles(session, flush_context):
+    user_ids = set()
+    for i in itertools.chain(session.new, session.dirty, session.deleted):
+        if isinstance(i, model.User):
+            user_ids.add(i.id)
+        elif isinstance(i, model.Admin):
+            user_ids.add(i.user_id)
+        elif isinstance(i, model.Course):
+            if i in session.deleted:
+                forget_roles()
+                continue
+            state = sqlalchemy.inspect(i)
+            for name in ('teachers', 'students'):
+                history = state.attrs[name].history
+                user_ids.update(u.id for u in itertools.chain(history.added or (), history.deleted or ()))
+    forget_roles(user_ids)
+    for user_id in user_ids:
+        forget_user(user_id)
+
+def init_app(app):
+    sessions.maxsize = app.config['AUTH_CACHE_SIZE']
+    users.maxsize = app.config['AUTH_CACHE_SIZE']
+    role_index.maxsize = app.config['AUTH_CACHE_SIZE']
@@ -0,0 +1,324 @@
+from . import answers
+from . import auth
+from . import journal
+from . import live
+from . import model
+from . import resources
+from . import workers
+
+from flask import current_app
+from flask.cli import with_appcontext
+import click
+import csv
+import io
+import itertools
+import json
+import sqlalchemy
+import sqlalchemy.orm
+
+
+DELETE_CHUNK_SIZE = 500
+
+class InUse(Exception):
+    def __init__(self, module_ids):
+        self.module_ids = module_ids
+
+def lock(session):
+    # Takes SQLite's write lock up front, so ids read after this stay free
+    # until the transaction commits.
+    connection = session.connection()
+    if not connection.connection.in_transaction:
+        connection.execute('BEGIN IMMEDIATE')
+
+class Plan(object):
+    def __init__(self, session):
+        self.session = session
+        self.rows = {}
+        self.ids = {}
+        self.or_ignore = set()
+
+    def allocate(self, table):
+        if table not in self.ids:
+            lock(self.session)
+            # Ids of deleted rows are never handed out again, cached
+            # serializations may still be keyed by them.
+            used = self.session.execute(sqlalchemy.select([sqlalchemy.func.max(table.c.id)])).scalar() or 0
+            issued = self.session.execute(sqlalchemy.select([model.id_sequences.c.value]).where(model.id_sequences.c.name == table.name)).scalar() or 0
+            self.ids[table] = max(used, issued)
+        self.ids[table] += 1
+        return self.ids[table]
+
+    def add(self, table, **row):
+        self.rows.setdefault(table, []).append(row)
+
+    def ignore_duplicates(self, table):
+        self.or_ignore.add(table)
+
+    def insert(self, table, **row):
+        row['id'] = self.allocate(table)
+        self.add(table, **row)
+        return row['id']
+
+    def execute(self):
+        # One executemany per table, parents before children.
+        for table in model.db.metadata.sorted_tables:
+            if table in self.rows:
+                statement = table.insert()
+                if table in self.or_ignore:
+                    statement = statement.prefix_with('OR IGNORE')
+                self.session.execute(statement, self.rows.pop(table))
+        if self.ids:
+            self.session.execute(model.id_sequences.insert().prefix_with('OR REPLACE'), [{'name': table.name, 'value': value} for table, value in self.ids.items()])
+
+
+def delete_course_statements(course_id):
+    # Children before parents; question ids are read up front because the
+    # text modules linking them to the course are deleted first.
+    session = model.db.session
+    modules = sqlalchemy.select([model.Module.id]).where(model.Module.course_id == course_id)
+    lectures = sqlalchemy.select([model.Lecture.id]).where(model.Lecture.course_id == course_id)
+    started_lectures = sqlalchemy.select([model.StartedLecture.id]).where(model.StartedLecture.lecture_id.in_(lectures))
+    module_ids = [id for id, in session.execute(modules)]
+    question_ids = [id for id, in session.execute(
+        sqlalchemy.select([model.TextModule.question_id])
+            .where(model.TextModule.module_id.in_(modules))
+            .where(model.TextModule.question_id.isnot(None))
+    )]
+
+    ret = [
+        model.QuestionResponse.__table__.delete().where(model.QuestionResponse.started_lecture_id.in_(started_lectures)),
+        model.LectureEvent.__table__.delete().where(model.LectureEvent.started_lecture_id.in_(started_lectures)),
+        model.StartedLecture.__table__.delete().where(model.StartedLecture.lecture_id.in_(lectures)),
+        model.lecture_questions.delete().where(model.lecture_questions.c.lecture_id.in_(lectures)),
+        model.lecture_modules.delete().where(model.lecture_modules.c.lecture_id.in_(lectures)),
+        model.Lecture.__table__.delete().where(model.Lecture.course_id == course_id),
+        model.test_block_modules.delete().where(model.test_block_modules.c.test_block_id.in_(modules)),
+        model.TextModule.__table__.delete().where(model.TextModule.module_id.in_(modules)),
+        model.Module.__table__.delete().where(model.Module.course_id == course_id),
+    ]
+    for i in range(0, len(question_ids), DELETE_CHUNK_SIZE):
+        chunk = question_ids[i:i + DELETE_CHUNK_SIZE]
+        ret.append(model.lecture_questions.delete().where(model.lecture_questions.c.question_id.in_(chunk)))
+        for table in (model.MultipleChoiceQuestionVariant, model.MultipleSelectQuestionVariant, model.MultipleChoiceQuestion, model.FreeResponseQuestion):
+            ret.append(table.__table__.delete().where(table.question_id.in_(chunk)))
+        ret.append(model.Question.__table__.delete().where(model.Question.id.in_(chunk)))
+    ret += [
+        model.teachers.delete().where(model.teachers.c.course_id == course_id),
+        model.students.delete().where(model.students.c.course_id == course_id),
+        model.Course.__table__.delete().where(model.Course.id == course_id),
+    ]
+    identity_keys = [sqlalchemy.orm.util.identity_key(model.Module, id) for id in module_ids]
+    identity_keys += [sqlalchemy.orm.util.identity_key(model.Question, id) for id in question_ids]
+    return ret, identity_keys
+
+def shared_modules(course_id):
+    # Modules of the course that lectures or test blocks of other courses
+    # still use; deleting them would silently change those.
+    modules = sqlalchemy.select([model.Module.id]).where(model.Module.course_id == course_id)
+    lectures = sqlalchemy.select([model.Lecture.id]).where(model.Lecture.course_id == course_id)
+    return sorted({id for id, in model.db.session.execute(sqlalchemy.union(
+        sqlalchemy.select([model.lecture_modules.c.module_id])
+            .where(model.lecture_modules.c.module_id.in_(modules))
+            .where(model.lecture_modules.c.lecture_id.notin_(lectures)),
+        sqlalchemy.select([model.test_block_modules.c.module_id])
+            .where(model.test_block_modules.c.module_id.in_(modules))
+            .where(model.test_block_modules.c.test_block_id.notin_(modules)),
+    ))})
+
+def delete_course(course_id, job=None):
+    # One transaction under the write lock, so the rows it deletes are the
+    # rows there are and a failure leaves the course as it was.
+    session = model.db.session
+    lock(session)
+    try:
+        shared = shared_modules(course_id)
+        if shared:
+            raise InUse(shared)
+        lecture_ids = [id for id, in session.execute(sqlalchemy.select([model.Lecture.id]).where(model.Lecture.course_id == course_id))]
+        started_lecture_ids = [id for id, in session.execute(sqlalchemy.select([model.StartedLecture.id]).where(model.StartedLecture.lecture_id.in_(lecture_ids)))]
+        statements, identity_keys = delete_course_statements(course_id)
+        if job is not None:
+            job.total = len(statements)
+        for statement in statements:
+            session.execute(statement)
+            if job is not None:
+                job.advance()
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+    journal.forget(started_lecture_ids)
+    resources.invalidate_serialized(identity_keys)
+    for lecture_id in lecture_ids:
+        model.playlists.pop(lecture_id)
+        answers.keys.pop(lecture_id)
+    live.forget(started_lecture_ids)
+    auth.forget_roles()
+
+def delete_course_job(course_id):
+    # Holding SQLite's write lock for the whole delete would stall the hub,
+    # so the job waits for it on the database pool.
+    app = current_app._get_current_object()
+    def work(job):
+        with app.app_context():
+            delete_course(course_id, job)
+    return lambda job: workers.database.resume(work, job)
+
+
+import_row_schema = {
+    '$schema': 'http://json-schema.org/schema#',
+    'type': 'object',
+    'properties': {
+        'email': {'type': 'string'},
+        'password': {'type': 'string'},
+        'first_name': {'type': 'string'},
+        'last_name': {'type': 'string'},
+        'middle_name': {'type': 'string'},
+        'university': {'type': 'string'},
+        'university_group': {'type': 'string'},
+        'course_id': {'type': 'integer'},
+        'role': {'enum': ['student', 'teacher']},
+    },
+    'required': ['email'],
+}
+
+import_row_validator = resources.schema_validator(import_row_schema)
+
+import_report_schema = {
+    'type': 'object',
+    'properties': {
+        'rows': {'type': 'integer'},
+        'created': {'type': 'integer'},
+        'enrolled': {'type': 'integer'},
+        'errors': {
+            'type': 'array',
+            'items': {
+                'type': 'object',
+                'properties': {
+                    'row': {'type': 'integer'},
+                    'error': {'type': 'string'},
+                    'path': {'type': 'string'},
+                },
+                'required': ['row', 'error'],
+            },
+        },
+    },
+    'required': ['rows', 'created', 'enrolled', 'errors'],
+}
+
+def read_rows(stream, format):
+    # Yields one dict per input row (None for rows that don't parse) without
+    # reading the whole input first.
+    if format == 'csv':
+        for row in csv.DictReader(io.TextIOWrapper(stream, encoding='utf-8', newline='')):
+            row = {k: v for k, v in row.items() if k is not None and v not in (None, '')}
+            if 'course_id' in row:
+                try:
+                    row['course_id'] = int(row['course_id'])
+                except ValueError:
+                    pass
+            yield row
+    else:
+        for line in io.TextIOWrapper(stream, encoding='utf-8'):
+            if not line.strip():
+                continue
+            try:
+                yield json.loads(line)
+            except ValueError:
+                yield None
+
+def import_users(rows, chunk_size):
+    report = {'rows': 0, 'created': 0, 'enrolled': 0, 'errors': []}
+    known = {}
+    rows = enumerate(rows, 1)
+    while True:
+        chunk = list(itertools.islice(rows, chunk_size))
+        if not chunk:
+            report['errors'].sort(key=lambda error: error['row'])
+            return report
+        import_chunk(chunk, known, report)
+
+def import_chunk(chunk, known, report):
+    session = model.db.session
+    report['rows'] += len(chunk)
+
+    valid = []
+    for n, row in chunk:
+        if not import_row_validator.is_valid(row):
+            report['errors'].append({'row': n, 'error': 'bad_request'})
+        else:
+            valid.append((n, row))
+
+    emails = {row['email'] for n, row in valid} - known.keys()
+    if emails:
+        known.update(session.query(model.User.email, model.User.id).filter(model.User.email.in_(emails)))
+    course_ids = {row['course_id'] for n, row in valid if 'course_id' in row}
+    if course_ids:
+        course_ids = {course_id for course_id, in session.query(model.Course.id).filter(model.Course.id.in_(course_ids))}
+
+    new = {}
+    for n, row in valid:
+        if 'course_id' in row and row['course_id'] not in course_ids:
+            report['errors'].append({'row': n, 'error': 'not_found', 'path': '/courses/id'})
+        elif row['email'] not in known and row['email'] not in new:
+            missing = [key for key in ('password', 'first_name', 'last_name') if key not in row]
+            if missing:
+                report['errors'].append({'row': n, 'error': 'bad_request', 'path': '/' + missing[0]})
+            else:
+                new[row['email']] = row
+    new_rows = list(new.values())
+    # Hashing is slow, so it runs before the write lock is taken.
+    hashes = workers.hash_passwords(row['password'] for row in new_rows)
+
+    plan = Plan(session)
+    lock(session)
+    # Someone may have registered one of these emails while we were hashing.
+    taken = dict(session.query(model.User.email, model.User.id).filter(model.User.email.in_(new.keys()))) if new else {}
+    known.update(taken)
+    for row, password_hash in zip(new_rows, hashes):
+        if row['email'] in taken:
+            continue
+        known[row['email']] = plan.insert(model.User.__table__,
+            email=row['email'],
+            password=password_hash,
+            first_name=row['first_name'],
+            last_name=row['last_name'],
+            middle_name=row.get('middle_name', ''),
+            university=row.get('university', ''),
+            university_group=row.get('university_group', ''),
+            session_generation=0,
+        )
+        report['created'] += 1
+
+    plan.ignore_duplicates(model.students)
+    plan.ignore_duplicates(model.teachers)
+    enrolled = set()
+    for n, row in valid:
+        if 'course_id' in row and row['course_id'] in course_ids and row['email'] in known:
+            table = model.teachers if row.get('role') == 'teacher' else model.students
+            plan.add(table, user_id=known[row['email']], course_id=row['course_id'])
+            enrolled.add(known[row['email']])
+            report['enrolled'] += 1
+    plan.execute()
+    session.commit()
+    auth.forget_roles(enrolled)
+
+@click.command('import-users')
+@click.argument('file', type=click.File('rb'))
+@click.option('--format', type=click.Choice(['csv', 'jsonl']), default=None)
+@with_appcontext
+def import_users_command(file, format):
+    if format is None:
+        format = 'csv' if file.name.endswith('.csv') else 'jsonl'
+    try:
+        report = import_users(read_rows(file, format), current_app.config['IMPORT_CHUNK_SIZE'])
+    except workers.Busy:
+        # Chunks before this one are committed; running the import again
+        # skips the users they created.
+        raise click.ClickException('password hashing is busy, try the import again later')
+    for error in report['errors']:
+        click.echo(f"row {error['row']}: {error['error']} {error.get('path', '')}".rstrip(), err=True)
+    click.echo(f"{report['rows']} rows, {report['created']} users created, {report['enrolled']} enrollments")
+
+def init_app(app):
+    app.cli.add_command(import_users_command)
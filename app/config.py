@@ -5,6 +5,31 @@ class Base(object):
     DEBUG = False
     TESTING = False
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    PAGINATION_TOTAL_TTL = 60
+    STREAM_BATCH_SIZE = 100
+    IMPORT_CHUNK_SIZE = 500
+    RESPONSE_VALIDATION = 'full'
+    RESPONSE_VALIDATION_SAMPLE = 100
+    SERIALIZATION_CACHE_SIZE = 4096
+    PLAYLIST_CACHE_SIZE = 1024
+    BROADCAST_CACHE_SIZE = 1024
+    LIVE_FLUSH_DELAY = 0.5
+    LIVE_IDLE_TIMEOUT = 60 * 60
+    JOURNAL_COMMIT_DELAY = 0.05
+    ANSWER_COMMIT_DELAY = 0.01
+    ANSWER_BATCH_SIZE = 500
+    ANSWER_QUEUE_SIZE = 10000
+    ANSWER_KEY_CACHE_SIZE = 1024
+    AUTH_CACHE_SIZE = 10000
+    AUTH_CACHE_TTL = 60
+    AUTH_BACKEND = 'sessions'
+    AUTH_TOKEN_MAX_AGE = 30 * 24 * 60 * 60
+    PASSWORD_POOL_SIZE = 4
+    PASSWORD_POOL_QUEUE = 256
+    DB_THREADPOOL_SIZE = 0
+    DB_THREADPOOL_QUEUE = 1024
+    SQLITE_PRAGMAS = {'foreign_keys': 'ON'}
+    SQLITE_READ_POOL_SIZE = 0
 
     def __init__(self, app):
         pass
@@ -17,5 +42,22 @@ class Development(Base):
         self.SQLALCHEMY_ECHO = True
 
 class Production(Base):
+    RESPONSE_VALIDATION = 'sampled'
+    SQLITE_PRAGMAS = {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'mmap_size': 256 * 1024 * 1024,
+        'cache_size': -64 * 1024,
+        'busy_timeout': 5000,
+        'foreign_keys': 'ON',
+    }
+    SQLITE_READ_POOL_SIZE = 4
+    # One warm writer connection; WAL and busy_timeout serialize the writes.
+    # Overflow stays unbounded because under eventlet a green thread can hold
+    # a connection across a yield, and waiting on a full pool would block the
+    # hub it is waiting for.
+    SQLALCHEMY_POOL_SIZE = 1
+    SQLALCHEMY_MAX_OVERFLOW = -1
+
     def __init__(self, app):
         self.SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(app.instance_path, 'db.sqlite3')
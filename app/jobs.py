@@ -0,0 +1,90 @@
+from . import cache
+from . import model
+from . import workers
+
+from flask import current_app
+import secrets
+
+
+class Job(object):
+    def __init__(self, kind, total):
+        self.id = secrets.token_hex(8)
+        self.kind = kind
+        self.status = 'pending'
+        self.done = 0
+        self.total = total
+
+    def advance(self):
+        self.done += 1
+
+    def to_json(self):
+        return {'id': self.id, 'kind': self.kind, 'status': self.status, 'done': self.done, 'total': self.total}
+
+
+job_schema = {
+    'type': 'object',
+    'properties': {
+        'id': {'type': 'string'},
+        'kind': {'type': 'string'},
+        'status': {'enum': ['pending', 'running', 'done', 'failed']},
+        'done': {'type': 'integer'},
+        'total': {'type': 'integer'},
+    },
+    'required': ['id', 'kind', 'status', 'done', 'total'],
+}
+
+registry = cache.LRUCache(maxsize=100)
+deferred = workers.native_threading.local()
+spawn = None
+sleep = None
+event = None
+
+def start(run):
+    if getattr(workers.worker, 'active', False):
+        # Green threads spawned on a pool thread would wait for that thread's
+        # own hub, which never runs; the handler starts them on the main one.
+        if not hasattr(deferred, 'runs'):
+            deferred.runs = []
+        deferred.runs.append(run)
+    else:
+        spawn(run)
+
+def take_deferred():
+    ret = getattr(deferred, 'runs', [])
+    deferred.runs = []
+    return ret
+
+def submit(kind, total, fn):
+    job = Job(kind, total)
+    registry.set(job.id, job)
+    app = current_app._get_current_object()
+    def run():
+        with app.app_context():
+            job.status = 'running'
+            try:
+                fn(job)
+            except Exception:
+                model.db.session.rollback()
+                job.status = 'failed'
+                app.logger.exception('job %s (%s) failed', job.id, kind)
+            else:
+                job.status = 'done'
+    start(run)
+    return job
+
+def later(delay, fn):
+    app = current_app._get_current_object()
+    def run():
+        sleep(delay)
+        with app.app_context():
+            fn()
+    start(run)
+
+def get(id):
+    return registry.get(id)
+
+def init_app(app, socketio):
+    global spawn, sleep, event
+    spawn = socketio.start_background_task
+    sleep = socketio.sleep
+    event = socketio.server.eio.create_event
@@ -0,0 +1,85 @@
+from . import jobs
+from . import model
+from . import workers
+
+from datetime import datetime
+from flask import current_app
+
+
+buffer = []
+lock = workers.native_threading.Lock()
+scheduled = False
+
+def record(started_lecture_id, kind, user_id=None, module_number=None, module_started=None, question_number=None, response=None):
+    # Events are appended in memory and committed in groups, one
+    # transaction per JOURNAL_COMMIT_DELAY rather than one per event.
+    append(started_lecture_id, kind, user_id, module_number, module_started, question_number, response)
+    schedule()
+
+def append(started_lecture_id, kind, user_id=None, module_number=None, module_started=None, question_number=None, response=None):
+    row = {
+        'started_lecture_id': started_lecture_id,
+        'created_at': datetime.now(),
+        'kind': getattr(model.LectureEventKind, kind),
+        'user_id': user_id,
+        'module_number': module_number,
+        'module_started': module_started,
+        'question_number': question_number,
+        'response': response,
+    }
+    with lock:
+        buffer.append(row)
+
+def schedule():
+    global scheduled
+    delay = current_app.config['JOURNAL_COMMIT_DELAY']
+    with lock:
+        start = bool(delay) and not scheduled
+        if start:
+            scheduled = True
+    if not delay:
+        flush()
+    elif start:
+        jobs.later(delay, flush)
+
+insert_statement = model.LectureEvent.__table__.insert()
+
+def write(engine, rows):
+    # A connection of its own, so the caller's session is left as it was.
+    with engine.begin() as connection:
+        connection.execute(insert_statement, rows)
+
+def flush():
+    global scheduled
+    with lock:
+        rows = buffer[:]
+        buffer.clear()
+        scheduled = False
+    if not rows:
+        return
+    try:
+        workers.database.run(write, model.db.engine, rows)
+    except Exception:
+        current_app.logger.exception('failed to journal %d lecture events', len(rows))
+        delay = current_app.config['JOURNAL_COMMIT_DELAY']
+        with lock:
+            buffer[:0] = rows
+            start = bool(delay) and not scheduled
+            if start:
+                scheduled = True
+        if start:
+            jobs.later(delay, flush)
+
+def forget(started_lecture_ids):
+    started_lecture_ids = set(started_lecture_ids)
+    with lock:
+        buffer[:] = [row for row in buffer if row['started_lecture_id'] not in started_lecture_ids]
+
+def replay(started_lecture_id):
+    return model.LectureEvent.query.filter_by(started_lecture_id=started_lecture_id).order_by(model.LectureEvent.id)
+
+def last_transition(started_lecture_id):
+    return model.db.session.query(model.LectureEvent.module_number, model.LectureEvent.module_started) \
+        .filter_by(started_lecture_id=started_lecture_id, kind=model.LectureEventKind.module) \
+        .order_by(model.LectureEvent.id.desc()) \
+        .first()
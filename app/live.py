@@ -0,0 +1,183 @@
+from . import jobs
+from . import journal
+from . import model
+from . import workers
+
+from flask import current_app
+import atexit
+import sqlalchemy
+import sqlalchemy.orm
+import time
+
+
+class LiveLecture(object):
+    def __init__(self, id, lecture_id, started_at, current_module_number, current_module_started):
+        self.id = id
+        self.lecture_id = lecture_id
+        self.started_at = started_at
+        self.current_module_number = current_module_number
+        self.current_module_started = current_module_started
+        self.touched = time.monotonic()
+        self.lock = workers.native_threading.Lock()
+
+    def copy(self):
+        return LiveLecture(self.id, self.lecture_id, self.started_at, self.current_module_number, self.current_module_started)
+
+    def snapshot(self):
+        with self.lock:
+            return self.copy()
+
+
+registry = {}
+pending = set()
+pending_lock = workers.native_threading.Lock()
+scheduled = False
+
+def get(started_lecture_id):
+    ret = registry.get(started_lecture_id)
+    if ret is None:
+        row = model.db.session.query(
+            model.StartedLecture.id,
+            model.StartedLecture.lecture_id,
+            model.StartedLecture.started_at,
+            model.StartedLecture.current_module_number,
+            model.StartedLecture.current_module_started,
+        ).filter_by(id=started_lecture_id).one_or_none()
+        if row is None:
+            return None
+        ret = LiveLecture(*row)
+        # The journal is committed ahead of the table, so after a crash its
+        # last transition is the newer state.
+        last = journal.last_transition(started_lecture_id)
+        if last is not None:
+            ret.current_module_number, ret.current_module_started = last
+        trim()
+        ret = registry.setdefault(started_lecture_id, ret)
+    ret.touched = time.monotonic()
+    return ret
+
+def transition(started_lecture_id, step, user_id=None):
+    # Applies step to the lecture's state under its lock and returns what
+    # the state was right after; the journal and the table catch up later.
+    # The lock is native, so nothing under it may wait on the hub.
+    lecture = get(started_lecture_id)
+    if lecture is None:
+        return None
+    with lecture.lock:
+        step(lecture)
+        ret = lecture.copy()
+        journal.append(ret.id, 'module', user_id, module_number=ret.current_module_number, module_started=ret.current_module_started)
+    journal.schedule()
+    schedule(started_lecture_id)
+    return ret
+
+def instance(state):
+    # The StartedLecture for state, with the live columns as if loaded.
+    ret = model.StartedLecture.query.get(state.id)
+    sqlalchemy.orm.attributes.set_committed_value(ret, 'current_module_number', state.current_module_number)
+    sqlalchemy.orm.attributes.set_committed_value(ret, 'current_module_started', state.current_module_started)
+    return ret
+
+def forget(started_lecture_ids):
+    with pending_lock:
+        for id in started_lecture_ids:
+            registry.pop(id, None)
+            pending.discard(id)
+
+def trim():
+    # Lectures nobody has touched for LIVE_IDLE_TIMEOUT are dropped once
+    # their state has been written back; get loads them again if needed.
+    cutoff = time.monotonic() - current_app.config['LIVE_IDLE_TIMEOUT']
+    with pending_lock:
+        for id, lecture in list(registry.items()):
+            if lecture.touched < cutoff and id not in pending:
+                del registry[id]
+
+def schedule(started_lecture_id):
+    global scheduled
+    delay = current_app.config['LIVE_FLUSH_DELAY']
+    with pending_lock:
+        pending.add(started_lecture_id)
+        if scheduled or not delay:
+            start = False
+        else:
+            start = scheduled = True
+    if not delay:
+        flush()
+    elif start:
+        jobs.later(delay, flush)
+
+update_statement = model.StartedLecture.__table__.update() \
+    .where(model.StartedLecture.id == sqlalchemy.bindparam('_id')) \
+    .values(current_module_number=sqlalchemy.bindparam('_number'), current_module_started=sqlalchemy.bindparam('_started'))
+
+def write(engine, rows):
+    with engine.begin() as connection:
+        connection.execute(update_statement, rows)
+
+def flush():
+    global scheduled
+    journal.flush()
+    with pending_lock:
+        ids = list(pending)
+        pending.clear()
+        scheduled = False
+    rows = []
+    for id in ids:
+        lecture = registry.get(id)
+        if lecture is not None:
+            state = lecture.snapshot()
+            rows.append({'_id': id, '_number': state.current_module_number, '_started': state.current_module_started})
+    try:
+        if rows:
+            workers.database.run(write, model.db.engine, rows)
+    except Exception:
+        current_app.logger.exception('failed to persist %d started lectures', len(rows))
+        with pending_lock:
+            pending.update(row['_id'] for row in rows if row['_id'] in registry)
+        if current_app.config['LIVE_FLUSH_DELAY']:
+            schedule(rows[0]['_id'])
+    else:
+        trim()
+
+@sqlalchemy.event.listens_for(model.StartedLecture, 'load')
+@sqlalchemy.event.listens_for(model.StartedLecture, 'refresh')
+def overlay(target, context, attrs=None):
+    # Reads see the live state even before it has been written back.
+    lecture = registry.get(target.id)
+    if lecture is not None:
+        state = lecture.snapshot()
+        sqlalchemy.orm.attributes.set_committed_value(target, 'current_module_number', state.current_module_number)
+        sqlalchemy.orm.attributes.set_committed_value(target, 'current_module_started', state.current_module_started)
+
+def recover():
+    # The journal is committed ahead of the table, so after a crash the
+    # table is brought up to each lecture's last transition before anything
+    # reads it.
+    events = model.LectureEvent.__table__
+    started_lectures = model.StartedLecture.__table__
+    last = sqlalchemy.select([events.c.id]) \
+        .where(events.c.started_lecture_id == started_lectures.c.id) \
+        .where(events.c.kind == model.LectureEventKind.module) \
+        .order_by(events.c.id.desc()) \
+        .limit(1) \
+        .correlate(started_lectures)
+    def column(name):
+        return sqlalchemy.select([events.c[name]]).where(events.c.id == last.as_scalar()).correlate(started_lectures).as_scalar()
+    statement = started_lectures.update() \
+        .where(sqlalchemy.exists(last)) \
+        .values(current_module_number=column('module_number'), current_module_started=column('module_started'))
+    workers.database.run(write_statement, model.db.engine, statement)
+
+def write_statement(engine, statement):
+    with engine.begin() as connection:
+        connection.execute(statement)
+
+def init_app(app):
+    app.before_first_request(recover)
+
+    def flush_at_exit():
+        with app.app_context():
+            journal.flush()
+            flush()
+    atexit.register(flush_at_exit)
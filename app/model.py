@@ -1,13 +1,47 @@
+from . import cache
+
 from flask.cli import with_appcontext
-from flask_sqlalchemy import SQLAlchemy
 from sqlalchemy.ext.hybrid import hybrid_property
 from werkzeug.security import generate_password_hash, check_password_hash
 import click
+import collections
 import enum
+import flask_sqlalchemy
+import functools
+import sqlalchemy
+import sqlalchemy.pool
+
+
+readers = {}
+
+class RoutingSession(flask_sqlalchemy.SignallingSession):
+    def get_bind(self, mapper=None, clause=None):
+        if self.info.get('reader') and self.app in readers:
+            return readers[self.app]
+        return super().get_bind(mapper, clause)
 
+class SQLAlchemy(flask_sqlalchemy.SQLAlchemy):
+    def create_session(self, options):
+        return sqlalchemy.orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+    def apply_driver_hacks(self, app, info, options):
+        super().apply_driver_hacks(app, info, options)
+        if info.drivername == 'sqlite' and options.get('pool_size'):
+            # Pooled connections move between threads, one at a time.
+            options['poolclass'] = sqlalchemy.pool.QueuePool
+            options.setdefault('connect_args', {})['check_same_thread'] = False
 
 db = SQLAlchemy()
 
+def set_pragmas(pragmas, dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    for name, value in pragmas.items():
+        cursor.execute(f'PRAGMA {name} = {value}')
+    cursor.close()
+
+def use_reader():
+    db.session.info['reader'] = True
+
 admins = db.Table('admins', db.Column('user_id', db.Integer, db.ForeignKey('users.id'), primary_key=True))
 
 teachers = db.Table('teachers',
@@ -20,6 +54,14 @@ students = db.Table('students',
     db.Column('course_id', db.Integer, db.ForeignKey('courses.id'), primary_key=True),
 )
 
+class Admin(db.Model):
+    __table__ = admins
+
+id_sequences = db.Table('id_sequences',
+    db.Column('name', db.String, primary_key=True),
+    db.Column('value', db.Integer, nullable=False),
+)
+
 class User(db.Model):
     __tablename__ = 'users'
 
@@ -31,6 +73,7 @@ class User(db.Model):
     university_group = db.Column(db.String(128), nullable=False)
     email = db.Column(db.String(1024), unique=True, nullable=False)
     password = db.Column(db.String, nullable=False)
+    session_generation = db.Column(db.Integer, nullable=False, default=0)
 
     sessions = db.relationship('Session')
     teaches = db.relationship('Course', secondary=teachers)
@@ -39,26 +82,30 @@ class User(db.Model):
     created_modules = db.relationship('Module')
     started_lectures = db.relationship('StartedLecture')
     responses = db.relationship('QuestionResponse')
+    admin_entry = db.relationship('Admin', uselist=False, cascade='all, delete-orphan')
 
-    def __init__(self, *, password=None, **kwargs):
+    def __init__(self, *, password=None, password_hash=None, **kwargs):
         if password is not None:
-            password = generate_password_hash(password)
-        super().__init__(password=password, **kwargs)
+            password_hash = generate_password_hash(password)
+        super().__init__(password=password_hash, **kwargs)
 
     def check_password(self, password):
         return check_password_hash(self.password, password)
 
     @hybrid_property
     def admin(self):
-        return db.session.execute(admins.select().where(admins.c.user_id == self.id)).fetchone() is not None
+        return self.admin_entry is not None
 
     @admin.setter
     def admin(self, value):
-        a = self.admin
-        if value and not a:
-            db.session.execute(admins.insert().values((self.id,)))
-        elif not value and a:
-            db.session.execute(admins.delete().where(admins.c.user_id == self.id))
+        if value and self.admin_entry is None:
+            self.admin_entry = Admin()
+        elif not value:
+            self.admin_entry = None
+
+    @admin.expression
+    def admin(cls):
+        return db.exists().where(admins.c.user_id == cls.id)
 
 class Session(db.Model):
     __tablename__ = 'sessions'
@@ -165,6 +212,8 @@ class Module(db.Model):
     created_at = db.Column(db.DateTime, nullable=False)
     author_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
     course_id = db.Column(db.Integer, db.ForeignKey('courses.id'), nullable=False)
+    # Set on creation: a text module with a question or a test block.
+    has_question = db.Column(db.Boolean, nullable=False, default=False)
 
     author = db.relationship('User')
     course = db.relationship('Course')
@@ -199,10 +248,54 @@ class Lecture(db.Model):
 
     modules = db.relationship('Module', secondary=lecture_modules, order_by=lecture_modules.c.number)
     questions = db.relationship('Question', secondary=lecture_questions, order_by=lecture_questions.c.number)
+    modules_without_questions = db.relationship('Module',
+        secondary = lecture_modules,
+        primaryjoin = id == lecture_modules.c.lecture_id,
+        secondaryjoin = db.and_(Module.id == lecture_modules.c.module_id, Module.has_question == False),
+        order_by = lecture_modules.c.number,
+        viewonly = True,
+    )
 
-    @hybrid_property
-    def modules_without_questions(self):
-        return [m for m in self.modules if not (m.type == ModuleType.test_block or (m.type == ModuleType.text and m.text_module[0].question is not None))]
+    @property
+    def playlist(self):
+        return playlist(self.id)
+
+class PlaylistEntry(collections.namedtuple('PlaylistEntry', ['module_id', 'type', 'has_question', 'question_numbers'])):
+    @property
+    def initially_started(self):
+        # Modules that collect answers wait for the lecturer to start them.
+        return False if self.has_question else None
+
+playlists = cache.LRUCache()
+
+def playlist(lecture_id):
+    # Lectures never change after creation, so the module sequence is read
+    # once and then served from memory.
+    ret = playlists.get(lecture_id)
+    if ret is None:
+        rows = db.session.query(lecture_modules.c.module_id, Module.type, Module.has_question) \
+            .join(Module, Module.id == lecture_modules.c.module_id) \
+            .filter(lecture_modules.c.lecture_id == lecture_id) \
+            .order_by(lecture_modules.c.number) \
+            .all()
+        question_numbers = collections.defaultdict(list)
+        if any(has_question for module_id, type, has_question in rows):
+            # Lecture question numbers by the module they are asked in; a
+            # test block asks the questions of its modules.
+            owners = sqlalchemy.union_all(
+                sqlalchemy.select([lecture_modules.c.number, lecture_modules.c.module_id])
+                    .where(lecture_modules.c.lecture_id == lecture_id),
+                sqlalchemy.select([lecture_modules.c.number, test_block_modules.c.module_id])
+                    .select_from(lecture_modules.join(test_block_modules, test_block_modules.c.test_block_id == lecture_modules.c.module_id))
+                    .where(lecture_modules.c.lecture_id == lecture_id),
+            ).alias()
+            for module_number, question_number in db.session.query(owners.c.number, lecture_questions.c.number) \
+                    .join(TextModule, TextModule.module_id == owners.c.module_id) \
+                    .join(lecture_questions, db.and_(lecture_questions.c.question_id == TextModule.question_id, lecture_questions.c.lecture_id == lecture_id)):
+                question_numbers[module_number].append(question_number)
+        ret = tuple(PlaylistEntry(*row, frozenset(question_numbers[n])) for n, row in enumerate(rows))
+        playlists.set(lecture_id, ret)
+    return ret
 
 class StartedLecture(db.Model):
     __tablename__ = 'started_lectures'
@@ -224,11 +317,15 @@ class StartedLecture(db.Model):
 
     @hybrid_property
     def current_module(self):
-        mod = db.session.query(Module) \
-            .join(lecture_modules, lecture_modules.c.module_id == Module.id) \
-            .filter(lecture_modules.c.lecture_id == self.lecture_id) \
-            .filter(lecture_modules.c.number == self.current_module_number).one_or_none()
-        return mod
+        entries = playlist(self.lecture_id)
+        if self.current_module_number is None or not 0 <= self.current_module_number < len(entries):
+            return None
+        module_id = entries[self.current_module_number].module_id
+        # Keeps the module referenced, the session's identity map alone
+        # would let it be collected between two reads.
+        if getattr(self, '_current_module', None) is None or self._current_module.id != module_id:
+            self._current_module = Module.query.get(module_id)
+        return self._current_module
 
 class QuestionResponse(db.Model):
     __tablename__ = 'question_responses'
@@ -244,15 +341,70 @@ class QuestionResponse(db.Model):
 
     @hybrid_property
     def question(self):
-        return db.session.query(Question) \
-            .join(lecture_questions, lecture_questions.c.question_id == Question.id) \
-            .filter(lecture_questions.c.lecture_id == self.started_lecture.lecture_id) \
-            .filter(lecture_questions.c.number == self.question_number).one_or_none()
+        return questions_by_number(self.started_lecture.lecture_id).get(self.question_number)
+
+ANSWER_RELATIONSHIPS = ('multiple_choice_question', 'multiple_choice_question_variants', 'multiple_select_question_variants', 'free_response_question')
+
+def questions_by_number(lecture_id, answers=False):
+    # Resolves every question of a lecture at once and keeps the map for the
+    # rest of the session, so per-response lookups don't query. With
+    # answers, the variants and correct answers are loaded up front too.
+    memo = db.session.info.setdefault('questions_by_number', {})
+    ret = memo.get((lecture_id, True))
+    if ret is None:
+        ret = memo.get((lecture_id, answers))
+    if ret is None:
+        query = db.session.query(lecture_questions.c.number, Question) \
+            .join(Question, Question.id == lecture_questions.c.question_id) \
+            .filter(lecture_questions.c.lecture_id == lecture_id)
+        if answers:
+            query = query.options(*(sqlalchemy.orm.selectinload(getattr(Question, name)) for name in ANSWER_RELATIONSHIPS))
+        ret = memo[lecture_id, answers] = dict(query)
+    return ret
+
+class LectureEventKind(enum.Enum):
+    join = 1
+    present = 2
+    leave = 3
+    module = 4
+    answer = 5
+
+class LectureEvent(db.Model):
+    __tablename__ = 'lecture_events'
+
+    id = db.Column(db.Integer, primary_key=True)
+    started_lecture_id = db.Column(db.Integer, db.ForeignKey('started_lectures.id'), nullable=False, index=True)
+    created_at = db.Column(db.DateTime, nullable=False)
+    kind = db.Column(db.Enum(LectureEventKind), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=True)
+    module_number = db.Column(db.Integer, nullable=True)
+    module_started = db.Column(db.Boolean, nullable=True)
+    question_number = db.Column(db.Integer, nullable=True)
+    response = db.Column(db.String, nullable=True)
+
+    started_lecture = db.relationship('StartedLecture')
+    user = db.relationship('User')
 
 
 def init_app(app):
     db.init_app(app)
+    playlists.maxsize = app.config['PLAYLIST_CACHE_SIZE']
+    pragmas = app.config['SQLITE_PRAGMAS']
+    engine = db.get_engine(app)
+    if engine.dialect.name == 'sqlite':
+        sqlalchemy.event.listen(engine, 'connect', functools.partial(set_pragmas, pragmas))
+        if app.config['SQLITE_READ_POOL_SIZE']:
+            # WAL lets these read alongside the single writer connection.
+            readers[app] = sqlalchemy.create_engine(
+                engine.url,
+                poolclass=sqlalchemy.pool.QueuePool,
+                pool_size=app.config['SQLITE_READ_POOL_SIZE'],
+                max_overflow=-1,
+                connect_args={'check_same_thread': False},
+            )
+            sqlalchemy.event.listen(readers[app], 'connect', functools.partial(set_pragmas, dict(pragmas, query_only='ON')))
     app.cli.add_command(init_db)
+    app.cli.add_command(upgrade_db)
 
 @click.command('init-db')
 @click.option('--password', prompt='admin password', hide_input=True, confirmation_prompt=True)
@@ -264,3 +416,23 @@ def init_db(password):
     u = User(first_name='Lucius', last_name='User', middle_name='Q.', university='', university_group='', email='admin@visualmath.ru', password=password, admin=True)
     db.session.add(u)
     db.session.commit()
+
+# Columns added to existing tables, with the statement that fills them in
+# for rows that predate them.
+added_columns = [
+    ('users', 'session_generation', 'INTEGER NOT NULL DEFAULT 0', None),
+    ('modules', 'has_question', 'BOOLEAN NOT NULL DEFAULT 0',
+        "UPDATE modules SET has_question = 1 WHERE type = 'test_block' OR id IN (SELECT module_id FROM text_modules WHERE question_id IS NOT NULL)"),
+]
+
+@click.command('upgrade-db')
+@with_appcontext
+def upgrade_db():
+    # Brings an existing database up to date without dropping any data.
+    db.create_all()
+    for table, column, definition, backfill in added_columns:
+        if column not in {row[1] for row in db.session.execute(f'PRAGMA table_info({table})')}:
+            db.session.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
+            if backfill is not None:
+                db.session.execute(backfill)
+    db.session.commit()
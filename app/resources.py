@@ -1,8 +1,205 @@
+from . import cache
 from . import model
-from flask import request
+from flask import current_app, g, has_request_context, request
+import base64
+import itertools
+import json
+import jsonschema
+import sqlalchemy
+import sqlalchemy.orm
+import sqlalchemy.sql.util
+
+def schema_validator(schema):
+    cls = jsonschema.validators.validator_for(schema)
+    cls.check_schema(schema)
+    return cls(schema)
+
+type_checks = {
+    'null': '{0} is None',
+    'boolean': 'type({0}) is bool',
+    'integer': '(type({0}) is int or type({0}) is float and {0}.is_integer())',
+    'number': 'type({0}) in (int, float)',
+    'string': 'type({0}) is str',
+    'array': 'type({0}) is list',
+    'object': 'type({0}) is dict',
+}
+
+def compile_check(schema, var, prefix, env):
+    # Covers what resource schemas are made of; anything fancier is left to
+    # jsonschema.
+    keys = set(schema) - {'$schema', '$id'}
+    if keys == {'anyOf'}:
+        return '(' + ' or '.join(compile_check(s, var, f'{prefix}_{n}', env) for n, s in enumerate(schema['anyOf'])) + ')'
+    if keys == {'oneOf'}:
+        return '(' + ' + '.join(f'bool({compile_check(s, var, f"{prefix}_{n}", env)})' for n, s in enumerate(schema['oneOf'])) + ' == 1)'
+    if schema.get('type') == 'object' and keys <= {'type', 'properties', 'required'}:
+        env[prefix] = compile_object_check(schema)
+        return f'{prefix}({var})'
+    if keys - {'type', 'enum', 'items'} or schema.get('type') not in type_checks or ('items' in schema and schema['type'] != 'array'):
+        env[prefix] = schema_validator(schema).is_valid
+        return f'{prefix}({var})'
+    ret = [type_checks[schema['type']].format(var)]
+    if 'enum' in schema:
+        env[prefix + '_enum'] = schema['enum']
+        ret.append(f'{var} in {prefix}_enum')
+    if 'items' in schema:
+        ret.append(f'all({compile_check(schema["items"], var + "_", prefix + "_items", env)} for {var}_ in {var})')
+    return '(' + ' and '.join(ret) + ')'
+
+def compile_object_check(schema):
+    env = {}
+    required = schema.get('required', [])
+    lines = [
+        'def check(v):',
+        '    if type(v) is not dict:',
+        '        return False',
+        '    try:',
+    ]
+    for name in required:
+        if name not in schema.get('properties', {}):
+            lines.append(f'        v[{name!r}]')
+    for n, (name, subschema) in enumerate(schema.get('properties', {}).items()):
+        indent = '        '
+        if name not in required:
+            lines.append(f'        if {name!r} in v:')
+            indent += '    '
+        lines.append(f'{indent}x = v[{name!r}]')
+        lines.append(f'{indent}if not {compile_check(subschema, "x", f"p{n}", env)}:')
+        lines.append(f'{indent}    return False')
+    lines.extend([
+        '    except KeyError:',
+        '        return False',
+        '    return True',
+    ])
+    exec('\n'.join(lines) + '\n', env)
+    return env['check']
+
+def schema_checker(schema):
+    # Plain Python equivalent of schema_validator(schema).is_valid.
+    env = {}
+    exec(f'def check(v):\n    return {compile_check(schema, "v", "c", env)}\n', env)
+    return env['check']
+
+class InvalidCursor(Exception): pass
+
+totals = cache.LRUCache()
+
+def cached_count(query):
+    stmt = query.statement
+    tables = frozenset(t.name for t in sqlalchemy.sql.util.find_tables(stmt) if isinstance(t, sqlalchemy.Table))
+    key = (tables, str(stmt), tuple(sorted(stmt.compile().params.items())))
+    total = totals.get(key)
+    if total is None:
+        total = query.count()
+        totals.set(key, total, ttl=current_app.config['PAGINATION_TOTAL_TTL'])
+    return total
+
+@sqlalchemy.event.listens_for(sqlalchemy.engine.Engine, 'after_execute')
+def invalidate_totals(conn, clauseelement, multiparams, params, result):
+    # Every write goes through here, ORM flushes and bulk statements alike.
+    # A count read concurrently from an older snapshot can still be cached
+    # until the TTL runs out.
+    if isinstance(clauseelement, sqlalchemy.sql.dml.UpdateBase):
+        name = clauseelement.table.name
+        totals.pop_matching(lambda key, value: name in key[0])
+
+def encode_cursor(values):
+    return base64.urlsafe_b64encode(json.dumps(list(values)).encode()).decode().rstrip('=')
+
+def decode_cursor(token, columns):
+    # Cursors come from clients, so they are checked against the primary key
+    # before they are bound into a query.
+    if token == '':
+        return None
+    try:
+        values = json.loads(base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)))
+    except ValueError:
+        raise InvalidCursor
+    if not (type(values) is list and len(values) == len(columns)):
+        raise InvalidCursor
+    if not all(type(v) is c.type.python_type for v, c in zip(values, columns)):
+        raise InvalidCursor
+    return values
+
+def request_memo():
+    if not has_request_context():
+        return {}
+    if 'serialization_memo' not in g:
+        g.serialization_memo = {}
+    return g.serialization_memo
+
+def freeze(includes):
+    return tuple((k, freeze(v)) for k, v in includes.items())
+
+includes_keys = {}
+includes_counter = itertools.count()
+
+def includes_key(includes):
+    # Equal include trees get the same small key, which is cheap to hash and
+    # stays valid after the tree itself is gone.
+    return includes_keys.setdefault(freeze(includes), next(includes_counter))
+
+def memoized(serializer, includes):
+    # Within a request, each persistent object is serialized at most once per
+    # include tree; repeated authors, courses and lectures reuse the same dict.
+    key_suffix = includes_key(includes)
+    def serialize(res, memo):
+        key = res._sa_instance_state.key
+        if key is None:
+            return serializer(res, memo)
+        key = (key, key_suffix)
+        try:
+            return memo[key]
+        except KeyError:
+            ret = memo[key] = serializer(res, memo)
+            return ret
+    return serialize
+
+serialized = cache.LRUCache()
+
+def cached(static, dynamic, includes):
+    # Fields of immutable resources that do not reach into mutable ones are
+    # kept across requests; the rest (authors, courses) is rebuilt every time.
+    key_suffix = includes_key(includes)
+    def serialize(res, memo):
+        key = (res._sa_instance_state.key, key_suffix)
+        if key[0] is None:
+            ret = static(res, memo)
+        else:
+            ret = serialized.get(key)
+            if ret is None:
+                ret = static(res, memo)
+                serialized.set(key, ret)
+            ret = dict(ret)
+        ret.update(dynamic(res, memo))
+        return ret
+    return serialize
+
+def invalidate_serialized(identity_keys):
+    identity_keys = set(identity_keys)
+    if any(k[0] is model.Question for k in identity_keys):
+        # Module entries embed their questions.
+        identity_keys.update(k[0] for k in serialized.keys() if k[0][0] is model.Module)
+    if identity_keys:
+        serialized.pop_matching(lambda key, value: key[0] in identity_keys)
+
+@sqlalchemy.event.listens_for(sqlalchemy.orm.Session, 'after_flush')
+def invalidate_deleted(session, flush_context):
+    invalidate_serialized(sqlalchemy.inspect(i).key for i in session.deleted if isinstance(i, (model.Module, model.Question)))
+
+def eager_load(model_class, path):
+    # Collections are loaded with one extra SELECT ... IN per level, scalar
+    # relationships are joined into the parent query.
+    ret = None
+    for name in path:
+        attr = getattr(model_class, name)
+        loader = 'selectinload' if attr.property.uselist else 'joinedload'
+        ret = getattr(sqlalchemy.orm, loader)(attr) if ret is None else getattr(ret, loader)(attr)
+        model_class = attr.property.mapper.class_
+    return ret
 
 class Property(object):
-    def __init__(self, *, name=None, jsontype=None, getter=None, resource=None, many=False, nullable=False):
+    def __init__(self, *, name=None, jsontype=None, getter=None, resource=None, many=False, nullable=False, load=None):
         self.name = name
         if isinstance(jsontype, str):
             self.jsontype = {'type': jsontype}
@@ -12,9 +209,13 @@ class Property(object):
             self.getter = lambda res: getattr(res, self.name)
         else:
             self.getter = getter
+        self.custom_getter = getter is not None
         self.resource = resource
         self.many = many
         self.nullable = nullable
+        if isinstance(load, tuple):
+            load = [load]
+        self.load = load
 
     def get(self, res, includes):
         subres = self.getter(res)
@@ -22,12 +223,51 @@ class Property(object):
             return None
         if self.resource is not None:
             if self.many:
-                return [self.resource.to_json(i, includes) for i in subres]
+                return [self.resource.interpret(i, includes) for i in subres]
             else:
-                return self.resource.to_json(subres, includes)
+                return self.resource.interpret(subres, includes)
         else:
             return subres
 
+    def compile(self, includes, prefix, env, loaded=False):
+        if self.custom_getter:
+            env[prefix + '_get'] = self.getter
+            value = f'{prefix}_get(res)'
+        elif loaded:
+            value = f'(d[{self.name!r}] if {self.name!r} in d else res.{self.name})'
+        else:
+            value = f'res.{self.name}'
+        if self.resource is None:
+            return value
+        serializer = self.resource.serializer(includes)
+        if not self.many:
+            serializer = memoized(serializer, includes)
+        if self.nullable and self.many:
+            env[prefix + '_ser'] = lambda subres, memo: None if subres is None else [serializer(i, memo) for i in subres]
+        elif self.nullable:
+            env[prefix + '_ser'] = lambda subres, memo: None if subres is None else serializer(subres, memo)
+        elif self.many:
+            env[prefix + '_ser'] = serializer
+            return f'[{prefix}_ser(i, memo) for i in {value}]'
+        else:
+            env[prefix + '_ser'] = serializer
+        return f'{prefix}_ser({value}, memo)'
+
+    def static(self, includes):
+        return self.resource is None or self.resource.static(includes)
+
+    def paths(self, includes, model_class):
+        load = self.load
+        if load is None:
+            if not self.custom_getter and self.name in sqlalchemy.inspect(model_class).relationships.keys():
+                load = [(self.name,)]
+            else:
+                load = []
+        ret = list(load)
+        if self.resource is not None and load:
+            ret.extend(load[0] + path for path in self.resource.paths(includes))
+        return ret
+
     def schema(self, includes):
         if self.resource is not None:
             if self.many:
@@ -41,8 +281,14 @@ class Property(object):
         return ret
 
 class Resource(object):
-    def __init__(self):
+    def __init__(self, model_class=None, immutable=False, cached=None):
+        self.model_class = model_class
+        self.immutable = immutable
+        self.cached = immutable if cached is None else cached
         self.properties = {}
+        self.serializers = cache.LRUCache()
+        self.loaders = cache.LRUCache()
+        self.validators = cache.LRUCache()
 
     def __setitem__(self, key, value):
         if isinstance(value, Property):
@@ -51,12 +297,71 @@ class Resource(object):
         else:
             self.properties[key] = Property(name=key, jsontype=value)
 
-    def to_json(self, res, includes):
+    def interpret(self, res, includes):
         ret = {}
         for include, nested_includes in includes.items():
             ret[include] = self.properties[include].get(res, nested_includes)
         return ret
 
+    def compile(self, includes):
+        if not self.cached:
+            return self.compile_fields(includes)
+        static = {k: v for k, v in includes.items() if self.properties[k].static(v)}
+        dynamic = {k: v for k, v in includes.items() if k not in static}
+        return cached(self.compile_fields(static), self.compile_fields(dynamic), includes)
+
+    def static(self, includes):
+        return self.immutable and all(self.properties[k].static(v) for k, v in includes.items())
+
+    def compile_fields(self, includes):
+        # Mapped attributes are read straight from the instance __dict__, which
+        # skips SQLAlchemy's descriptors.  Anything that is not loaded yet falls
+        # back to regular attribute access, one field at a time.
+        mapped = sqlalchemy.inspect(self.model_class).attrs.keys() if self.model_class is not None else ()
+        env = {}
+        fields = []
+        for n, (include, nested_includes) in enumerate(includes.items()):
+            prop = self.properties[include]
+            fields.append(f'{include!r}: ' + prop.compile(nested_includes, f'p{n}', env, loaded=include in mapped))
+        exec(
+            'def serialize(res, memo):\n'
+            '    d = res.__dict__\n'
+            '    return {' + ', '.join(fields) + '}\n', env)
+        return env['serialize']
+
+    def compiled(self, compiled, includes, build):
+        # Include trees are mostly module-level constants, so they are looked
+        # up by identity. Entries keep their tree, so a reused id is never
+        # mistaken for it, and trees built on the fly are eventually evicted.
+        entry = compiled.get(id(includes))
+        if entry is None or entry[0] is not includes:
+            entry = (includes, build(includes))
+            compiled.set(id(includes), entry)
+        return entry[1]
+
+    def serializer(self, includes):
+        return self.compiled(self.serializers, includes, self.compile)
+
+    def to_json(self, res, includes):
+        return self.serializer(includes)(res, request_memo())
+
+    def paths(self, includes):
+        ret = []
+        for include, nested_includes in includes.items():
+            ret.extend(self.properties[include].paths(nested_includes, self.model_class))
+        return ret
+
+    def eager(self, includes):
+        return self.compiled(self.loaders, includes, self.compile_loaders)
+
+    def compile_loaders(self, includes):
+        paths = set(self.paths(includes))
+        leaves = [p for p in paths if not any(len(q) > len(p) and q[:len(p)] == p for q in paths)]
+        return [eager_load(self.model_class, p) for p in sorted(leaves)]
+
+    def validator(self, includes):
+        return self.compiled(self.validators, includes, lambda includes: schema_validator(self.schema(includes)))
+
     def schema(self, includes):
         properties = {}
         for include, nested_includes in includes.items():
@@ -80,72 +385,154 @@ class Resource(object):
         except ValueError:
             pagesize = maxpagesize
 
+        if 'after' in request.args and pagesize != 'all':
+            return self.cursor_to_json(query, includes, pagesize)
+
+        serialize = self.serializer(includes)
+        memo = request_memo()
         total = query.count()
+        query = query.options(*self.eager(includes))
         if pagesize == 'all':
-            pagesize = total
-            items = query.all()
-        else:
-            items = query.offset((page-1) * pagesize).limit(pagesize).all()
+            return Stream(
+                (serialize(i, memo) for i in query.yield_per(current_app.config['STREAM_BATCH_SIZE'])),
+                self.validator(includes),
+                page=page,
+                pagesize=total,
+                total=total,
+            )
+        items = query.offset((page-1) * pagesize).limit(pagesize).all()
 
         return {
-            'items': [self.to_json(i, includes) for i in items],
+            'items': [serialize(i, memo) for i in items],
             'page': page,
             'pagesize': pagesize,
             'total': total,
         }
 
+    def cursor_to_json(self, query, includes, pagesize):
+        serialize = self.serializer(includes)
+        pk = sqlalchemy.inspect(self.model_class).primary_key
+        after = decode_cursor(request.args['after'], pk)
+        ret = {'pagesize': pagesize}
+        if request.args.get('total', '') != 'none':
+            ret['total'] = cached_count(query)
+
+        if after is not None:
+            query = query.filter(sqlalchemy.tuple_(*pk) > sqlalchemy.tuple_(*after) if len(pk) > 1 else pk[0] > after[0])
+        items = query.options(*self.eager(includes)).order_by(*pk).limit(pagesize + 1).all()
+
+        if len(items) > pagesize:
+            items = items[:pagesize]
+            ret['after'] = encode_cursor(sqlalchemy.inspect(items[-1]).identity)
+        else:
+            ret['after'] = None
+        ret['items'] = [serialize(i, request_memo()) for i in items]
+        return ret
+
     def paginated_schema(self, includes):
         return {
-            'type': 'object',
-            'properties': {
-                'items': {
-                    'type': 'array',
-                    'items': self.schema(includes),
+            'anyOf': [
+                {
+                    'type': 'object',
+                    'properties': {
+                        'items': {
+                            'type': 'array',
+                            'items': self.schema(includes),
+                        },
+                        'page': {'type': 'integer'},
+                        'pagesize': {'type': 'integer'},
+                        'total': {'type': 'integer'},
+                    },
+                    'required': ['items', 'page', 'pagesize', 'total'],
                 },
-                'page': {'type': 'integer'},
-                'pagesize': {'type': 'integer'},
-                'total': {'type': 'integer'},
-            },
-            'required': ['items', 'page', 'pagesize', 'total'],
+                {
+                    'type': 'object',
+                    'properties': {
+                        'items': {
+                            'type': 'array',
+                            'items': self.schema(includes),
+                        },
+                        'pagesize': {'type': 'integer'},
+                        'total': {'type': 'integer'},
+                        'after': {'oneOf': [{'type': 'null'}, {'type': 'string'}]},
+                    },
+                    'required': ['items', 'pagesize', 'after'],
+                },
+            ],
         }
 
+class Stream(object):
+    def __init__(self, items, item_validator, **fields):
+        self.items = items
+        self.item_validator = item_validator
+        self.fields = fields
+
+    def encode(self, check=None):
+        # Emits {"items": [...], <fields>} one item at a time, so the listing
+        # is never materialized as a whole.
+        yield '{"items":['
+        for n, item in enumerate(self.items):
+            if check is not None:
+                check(item)
+            yield (',' if n else '') + json.dumps(item)
+        yield '],' + json.dumps(self.fields)[1:]
+
 class OneOfResource(Resource):
     def __init__(self, resources):
         self.resources = resources
+        self.model_class, = {r.model_class for r in resources.values()}
+        self.serializers = cache.LRUCache()
+        self.loaders = cache.LRUCache()
+        self.validators = cache.LRUCache()
 
-    def to_json(self, res, includes):
+    def interpret(self, res, includes):
         resource = self.resources[res.type]
         includes = includes[res.type]
-        return resource.to_json(res, includes)
+        return resource.interpret(res, includes)
+
+    def compile(self, includes):
+        serializers = {t: r.serializer(includes[t]) for t, r in self.resources.items() if t in includes}
+        return lambda res, memo: serializers[res.type](res, memo)
+
+    def static(self, includes):
+        return all(r.static(includes[t]) for t, r in self.resources.items() if t in includes)
+
+    def paths(self, includes):
+        ret = []
+        for t, r in self.resources.items():
+            if t in includes:
+                ret.extend(r.paths(includes[t]))
+        return ret
 
     def schema(self, includes):
         return {'anyOf': [r.schema(includes[t]) for t, r in self.resources.items()]}
 
 
-user = Resource()
-session = Resource()
-course = Resource()
-multiple_choice_question = Resource()
-multiple_select_question_variant = Resource()
-multiple_select_question = Resource()
-free_response_question = Resource()
+user = Resource(model.User)
+session = Resource(model.Session)
+course = Resource(model.Course)
+multiple_choice_question = Resource(model.Question, immutable=True)
+multiple_select_question_variant = Resource(model.MultipleSelectQuestionVariant, immutable=True, cached=False)
+multiple_select_question = Resource(model.Question, immutable=True)
+free_response_question = Resource(model.Question, immutable=True)
 question = OneOfResource({
     model.QuestionType.multiple_choice: multiple_choice_question,
     model.QuestionType.multiple_select: multiple_select_question,
     model.QuestionType.free_response: free_response_question,
 })
-text_module = Resource()
-text_module_with_question = Resource()
-visual_module = Resource()
-test_block_module = Resource()
+text_module = Resource(model.Module, immutable=True)
+text_module_with_question = Resource(model.Module, immutable=True)
+visual_module = Resource(model.Module, immutable=True)
+test_block_module = Resource(model.Module, immutable=True)
 module = OneOfResource({
     model.ModuleType.text: text_module,
     model.ModuleType.visual: visual_module,
     model.ModuleType.test_block: test_block_module,
 })
-lecture = Resource()
-started_lecture = Resource()
-question_response = Resource()
+lecture = Resource(model.Lecture)
+started_lecture = Resource(model.StartedLecture)
+question_response = Resource(model.QuestionResponse)
+lecture_event = Resource(model.LectureEvent)
 
 user['id'] = 'integer'
 user['first_name'] = 'string'
@@ -155,7 +542,7 @@ user['university'] = 'string'
 user['university_group'] = 'string'
 user['email'] = 'string'
 user['password'] = 'string'
-user['admin'] = 'boolean'
+user['admin'] = Property(jsontype='boolean', load=('admin_entry',))
 user['sessions'] = Property(resource=session, many=True)
 user['teaches'] = Property(resource=course, many=True)
 user['studues'] = Property(resource=course, many=True)
@@ -179,18 +566,18 @@ for q in (multiple_choice_question, multiple_select_question, free_response_ques
     q['id'] = 'integer'
 
 multiple_choice_question['type'] = Property(jsontype={'type': 'string', 'enum': ['multiple_choice']}, getter=lambda res: 'multiple_choice')
-multiple_choice_question['correct_answer'] = Property(jsontype='integer', getter=lambda res: res.multiple_choice_question[0].correct_answer)
-multiple_choice_question['variants'] = Property(jsontype={'type': 'array', 'items': {'type': 'string'}}, getter=lambda res: [i.text for i in res.multiple_choice_question_variants])
+multiple_choice_question['correct_answer'] = Property(jsontype='integer', getter=lambda res: res.multiple_choice_question[0].correct_answer, load=('multiple_choice_question',))
+multiple_choice_question['variants'] = Property(jsontype={'type': 'array', 'items': {'type': 'string'}}, getter=lambda res: [i.text for i in res.multiple_choice_question_variants], load=('multiple_choice_question_variants',))
 
 multiple_select_question_variant['correct'] = 'boolean'
 multiple_select_question_variant['text'] = 'string'
 
 multiple_select_question['type'] = Property(jsontype={'type': 'string', 'enum': ['multiple_select']}, getter=lambda res: 'multiple_select')
-multiple_select_question['variants'] = Property(resource=multiple_select_question_variant, many=True, getter=lambda res: res.multiple_select_question_variants)
+multiple_select_question['variants'] = Property(resource=multiple_select_question_variant, many=True, getter=lambda res: res.multiple_select_question_variants, load=('multiple_select_question_variants',))
 
 free_response_question['type'] = Property(jsontype={'type': 'string', 'enum': ['free_response']}, getter=lambda res: 'free_response')
-free_response_question['correct_answer'] = Property(jsontype='string', getter=lambda res: res.free_response_question[0].correct_answer)
-free_response_question['checker'] = Property(jsontype='string', getter=lambda res: res.free_response_question[0].checker.name)
+free_response_question['correct_answer'] = Property(jsontype='string', getter=lambda res: res.free_response_question[0].correct_answer, load=('free_response_question',))
+free_response_question['checker'] = Property(jsontype='string', getter=lambda res: res.free_response_question[0].checker.name, load=('free_response_question',))
 
 for m in (text_module, text_module_with_question, visual_module, test_block_module):
     m['id'] = 'integer'
@@ -203,10 +590,10 @@ for m in (text_module, text_module_with_question, visual_module, test_block_modu
 
 for m in (text_module, text_module_with_question):
     m['type'] = Property(jsontype={'type': 'string', 'enum': ['text']}, getter=lambda res: 'text')
-    m['text'] = Property(jsontype='string', getter=lambda res: res.text_module[0].text)
+    m['text'] = Property(jsontype='string', getter=lambda res: res.text_module[0].text, load=('text_module',))
 
-text_module['question'] = Property(resource=question, getter=lambda res: res.text_module[0].question, nullable=True)
-text_module_with_question['question'] = Property(resource=question, getter=lambda res: res.text_module[0].question)
+text_module['question'] = Property(resource=question, getter=lambda res: res.text_module[0].question, nullable=True, load=('text_module', 'question'))
+text_module_with_question['question'] = Property(resource=question, getter=lambda res: res.text_module[0].question, load=('text_module', 'question'))
 
 visual_module['type'] = Property(jsontype={'type': 'string', 'enum': ['visual']}, getter=lambda res: 'visual')
 
@@ -237,9 +624,21 @@ started_lecture['current_module_if_started'] = Property(resource=module, nullabl
 
 question_response['started_lecture_id'] = 'integer'
 question_response['user_id'] = 'integer'
-question_response['number'] = 'integer'
+question_response['number'] = Property(jsontype='integer', getter=lambda res: res.question_number)
 question_response['response'] = Property(jsontype='string', nullable=True)
 question_response['correct'] = Property(jsontype='boolean', nullable=True)
 question_response['started_lecture'] = Property(resource=started_lecture)
 question_response['user'] = Property(resource=user)
 question_response['question'] = Property(resource=question)
+
+lecture_event['id'] = 'integer'
+lecture_event['started_lecture_id'] = 'integer'
+lecture_event['created_at'] = Property(jsontype='number', getter=lambda res: res.created_at.timestamp())
+lecture_event['kind'] = Property(jsontype={'type': 'string', 'enum': [kind.name for kind in model.LectureEventKind]}, getter=lambda res: res.kind.name)
+lecture_event['user_id'] = Property(jsontype='integer', nullable=True)
+lecture_event['module_number'] = Property(jsontype='integer', nullable=True)
+lecture_event['module_started'] = Property(jsontype='boolean', nullable=True)
+lecture_event['question_number'] = Property(jsontype='integer', nullable=True)
+lecture_event['response'] = Property(jsontype='string', nullable=True)
+lecture_event['started_lecture'] = Property(resource=started_lecture)
+lecture_event['user'] = Property(resource=user)
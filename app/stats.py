@@ -0,0 +1,31 @@
+from collections import Counter
+import contextlib
+import eventlet.patcher
+import time
+
+
+counters = Counter()
+lock = eventlet.patcher.original('threading').Lock()
+sources = {}
+
+def register(name, source):
+    sources[name] = source
+
+@contextlib.contextmanager
+def timer(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        with lock:
+            counters[name + '_seconds'] += elapsed
+            counters[name + '_count'] += 1
+
+def snapshot():
+    with lock:
+        ret = dict(counters)
+    for name, source in sources.items():
+        for key, value in source().items():
+            ret[f'{name}_{key}'] = value
+    return ret
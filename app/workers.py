@@ -0,0 +1,142 @@
+from . import stats
+
+from concurrent.futures import ThreadPoolExecutor
+from werkzeug.security import generate_password_hash, check_password_hash
+import contextlib
+import eventlet.patcher
+import functools
+
+
+class Busy(Exception): pass
+
+
+# Monkey patching makes threading green: its locks can't be shared with
+# the native threads behind eventlet.tpool and its locals are per green
+# thread. State those threads touch uses the original module.
+native_threading = eventlet.patcher.original('threading')
+
+worker = native_threading.local()
+
+def mark_worker():
+    worker.active = True
+
+def work(fn, *args, **kwargs):
+    mark_worker()
+    return fn(*args, **kwargs)
+
+
+class Pool(object):
+    def __init__(self, name):
+        self.name = name
+        self.size = 0
+        self.max_pending = 0
+        self.pending = 0
+        self.rejected = 0
+        self.lock = native_threading.Lock()
+        self.executor = None
+        self.semaphore = None
+
+    def configure(self, size, max_pending, green=False):
+        # Under eventlet the work goes to eventlet.tpool and callers wait on
+        # the hub; otherwise it goes to a plain thread pool. A size of 0 runs
+        # everything inline.
+        self.size = size
+        self.max_pending = max_pending
+        if size == 0:
+            self.semaphore = None
+            self.executor = None
+        elif green:
+            import eventlet.semaphore
+            self.semaphore = eventlet.semaphore.Semaphore(size)
+            self.executor = None
+        else:
+            self.semaphore = None
+            self.executor = ThreadPoolExecutor(max_workers=size, thread_name_prefix=self.name, initializer=mark_worker)
+
+    def inline(self):
+        # Callers already on a pool thread (e.g. handlers on the database
+        # pool) can't wait on a green semaphore and don't block the hub.
+        if self.executor is None and self.semaphore is None:
+            return True
+        return getattr(worker, 'active', False)
+
+    @contextlib.contextmanager
+    def reserve(self, n):
+        with self.lock:
+            if self.pending + n > self.size + self.max_pending:
+                self.rejected += 1
+                raise Busy
+            self.pending += n
+        try:
+            with stats.timer(self.name):
+                yield
+        finally:
+            with self.lock:
+                self.pending -= n
+
+    def green_call(self, fn, *args, **kwargs):
+        import eventlet.tpool
+        with self.semaphore:
+            return eventlet.tpool.execute(work, fn, *args, **kwargs)
+
+    def run(self, fn, *args, **kwargs):
+        if self.inline():
+            return fn(*args, **kwargs)
+        with self.reserve(1):
+            if self.semaphore is not None:
+                return self.green_call(fn, *args, **kwargs)
+            return self.executor.submit(fn, *args, **kwargs).result()
+
+    def resume(self, fn, *args, **kwargs):
+        # Like run, for work that continues something already admitted (e.g.
+        # the rest of a stream): it waits for a thread instead of failing.
+        if self.inline():
+            return fn(*args, **kwargs)
+        with stats.timer(self.name):
+            if self.semaphore is not None:
+                return self.green_call(fn, *args, **kwargs)
+            return self.executor.submit(fn, *args, **kwargs).result()
+
+    def map(self, fn, items):
+        items = list(items)
+        if self.inline():
+            return [fn(i) for i in items]
+        ret = []
+        # Reserving in batches of at most the pool size keeps a long input
+        # from needing more room than the queue could ever have.
+        for start in range(0, len(items), self.size):
+            batch = items[start:start + self.size]
+            with self.reserve(len(batch)):
+                if self.semaphore is not None:
+                    import eventlet
+                    ret.extend(eventlet.GreenPool(self.size).imap(functools.partial(self.green_call, fn), batch))
+                else:
+                    ret.extend(self.executor.map(fn, batch))
+        return ret
+
+    def stats(self):
+        return {'size': self.size, 'pending': self.pending, 'rejected': self.rejected}
+
+
+passwords = Pool('password_pool')
+database = Pool('database_pool')
+
+def hash_password(password):
+    return passwords.run(generate_password_hash, password)
+
+def hash_passwords(values):
+    return passwords.map(generate_password_hash, values)
+
+def check_password(password_hash, password):
+    return passwords.run(check_password_hash, password_hash, password)
+
+def init_app(app, green=False):
+    nthreads = app.config['PASSWORD_POOL_SIZE'] + app.config['DB_THREADPOOL_SIZE']
+    if green and nthreads:
+        # Both pools share eventlet's native threads; size them to fit.
+        import eventlet.tpool
+        eventlet.tpool.set_num_threads(nthreads)
+    passwords.configure(app.config['PASSWORD_POOL_SIZE'], app.config['PASSWORD_POOL_QUEUE'], green)
+    database.configure(app.config['DB_THREADPOOL_SIZE'], app.config['DB_THREADPOOL_QUEUE'], green)
+    stats.register('password_pool', passwords.stats)
+    stats.register('database_pool', database.stats)
@@ -0,0 +1,76 @@
+from . import common
+from app import api, model, stats
+
+import eventlet
+import secrets
+import sys
+import time
+
+
+def setup(app, n):
+    teacher_id, student_id, course_id = common.make_users(app)
+    client = app.test_client()
+    teacher = common.login(client, 'teacher@bench')
+    rq = {'title': 'Quiz', 'course_id': course_id, 'modules': [{'title': 'q', 'type': 'text', 'text': 'q', 'question': common.question_rqs[0]}]}
+    client.post('/api/lectures', json=rq, headers={'Authorization': teacher})
+    with app.app_context():
+        lecture_id = model.Lecture.query.order_by(model.Lecture.id.desc()).first().id
+        # Sessions are made directly, logging hundreds of students in would
+        # mostly measure password hashing.
+        course = model.Course.query.get(course_id)
+        tokens = []
+        for i in range(n):
+            u = model.User(first_name='S', last_name='S', middle_name='S', university='', university_group='', email=f'student{i}@bench', password='')
+            course.students.append(u)
+            tokens.append(secrets.token_hex(16))
+            model.db.session.add(model.Session(id=tokens[-1], user=u))
+        model.db.session.commit()
+    client.post('/api/started_lectures', json={'lecture_id': lecture_id}, headers={'Authorization': teacher})
+    with app.app_context():
+        started_lecture_id = model.StartedLecture.query.order_by(model.StartedLecture.id.desc()).first().id
+
+    presenter = api.socketio.test_client(app, query_string=f'authorization={teacher}')
+    presenter.emit('present', {'id': started_lecture_id})
+    presenter.emit('start-module', {})
+    students = []
+    for token in tokens:
+        students.append(api.socketio.test_client(app, query_string=f'authorization={token}'))
+        students[-1].emit('join', {'id': started_lecture_id})
+    presenter.queue.clear()
+    # Handlers run concurrently from here on, as they do on a live server.
+    api.socketio.server.async_handlers = True
+    return students
+
+def answer_all(students):
+    sent = time.perf_counter()
+    for i, student in enumerate(students):
+        student.emit('answer', {'number': 0, 'response': str(i % 3)})
+    latencies = []
+    pending = students
+    while pending:
+        eventlet.sleep(0.001)
+        waiting = []
+        for student in pending:
+            if student.queue.get(student.sid):
+                assert student.queue[student.sid][-1]['args']['status'] == 'ok'
+                latencies.append(time.perf_counter() - sent)
+            else:
+                waiting.append(student)
+        pending = waiting
+    students[0].queue.clear()
+    return len(students) / max(latencies), common.percentiles(latencies)
+
+def main(n=500):
+    app = common.make_app()
+    students = setup(app, n)
+    print(f'{"delay":>8} {"answers/s":>10} {"p99 ack":>10} {"max ack":>10} {"commits":>8}')
+    for delay in (0, 0.002, 0.01, 0.05):
+        app.config['ANSWER_COMMIT_DELAY'] = delay
+        commits = stats.counters['answer_batch_count']
+        throughput, (p99, worst) = answer_all(students)
+        commits = stats.counters['answer_batch_count'] - commits
+        label = f'{delay * 1000:g}ms' if delay else 'each'
+        print(f'{label:>8} {throughput:>10.1f} {p99 * 1000:>8.1f}ms {worst * 1000:>8.1f}ms {commits:>8}')
+
+if __name__ == '__main__':
+    main(*(int(i) for i in sys.argv[1:]))
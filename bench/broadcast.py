@@ -0,0 +1,48 @@
+from . import common
+from app import api, model
+
+import sys
+
+
+def setup(app, room_size, modules):
+    teacher_id, student_id, course_id = common.make_users(app)
+    client = app.test_client()
+    teacher = common.login(client, 'teacher@bench')
+    student = common.login(client, 'student@bench')
+    client.post('/api/lectures', json=common.lecture_rq(course_id, modules), headers={'Authorization': teacher})
+    with app.app_context():
+        lecture_id = model.Lecture.query.order_by(model.Lecture.id.desc()).first().id
+    client.post('/api/started_lectures', json={'lecture_id': lecture_id}, headers={'Authorization': teacher})
+    with app.app_context():
+        started_lecture_id = model.StartedLecture.query.order_by(model.StartedLecture.id.desc()).first().id
+
+    presenter = api.socketio.test_client(app)
+    presenter.emit('present', {'id': started_lecture_id, 'authorization': teacher})
+    for i in range(room_size):
+        api.socketio.test_client(app).emit('join', {'id': started_lecture_id, 'authorization': student})
+
+    # The test client captures packets before they are encoded, encoding
+    # here keeps the cost of a real send in the measurement.
+    server = api.socketio.server
+    capture = server._send_packet
+    def send_packet(sid, pkt):
+        pkt.encode()
+        capture(sid, pkt)
+    server._send_packet = send_packet
+    return presenter, teacher
+
+def transitions(presenter, teacher, modules):
+    for event in ['next-module'] * (modules - 1) + ['prev-module'] * (modules - 1):
+        presenter.emit(event, {'authorization': teacher})
+    presenter.queue.clear()
+
+def main(modules=20):
+    print(f'{"room":>6} {"per transition":>16}')
+    for room_size in (5, 50, 500):
+        app = common.make_app()
+        presenter, teacher = setup(app, room_size, modules)
+        elapsed = common.best_of(lambda: transitions(presenter, teacher, modules), repeat=3)
+        print(f'{room_size:>6} {elapsed / (2 * modules - 2) * 1000:>14.2f}ms')
+
+if __name__ == '__main__':
+    main(*(int(i) for i in sys.argv[1:]))
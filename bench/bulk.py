@@ -0,0 +1,26 @@
+from . import common
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+import sys
+
+
+def main(sizes=(10, 50, 200, 1000)):
+    app = common.make_app()
+    teacher_id, student_id, course_id = common.make_users(app)
+    client = app.test_client()
+    token = common.login(client, 'teacher@bench')
+    statements = []
+    event.listen(Engine, 'before_cursor_execute', lambda *args: statements.append(args[2]))
+
+    print(f'{"modules":>8} {"statements":>11} {"time":>10}')
+    for n in sizes:
+        rq = common.lecture_rq(course_id, n)
+        del statements[:]
+        with common.Timer() as t:
+            rs = client.post('/api/lectures', json=rq, headers={'Authorization': token})
+        assert rs.status_code == 200
+        print(f'{n:>8} {len(statements):>11} {t.elapsed * 1000:>8.1f}ms')
+
+if __name__ == '__main__':
+    main(tuple(int(i) for i in sys.argv[1:]) or (10, 50, 200, 1000))
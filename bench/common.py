@@ -0,0 +1,87 @@
+from app import create_app, model, api
+
+import eventlet
+import tempfile
+import time
+
+
+def make_app(config_class='Production', **config):
+    app = create_app(config_class, instance_path=tempfile.mkdtemp(prefix='visualmath-bench-'))
+    app.config['SECRET_KEY'] = 'bench'
+    app.config.update(config)
+    with app.app_context():
+        model.db.create_all()
+    return app
+
+def make_users(app):
+    with app.app_context():
+        teacher = model.User(first_name='T', last_name='T', middle_name='T', university='', university_group='', email='teacher@bench', password='pw')
+        student = model.User(first_name='S', last_name='S', middle_name='S', university='', university_group='', email='student@bench', password='pw')
+        course = model.Course(title='Bench')
+        course.teachers.append(teacher)
+        course.students.append(student)
+        model.db.session.add_all([teacher, student, course])
+        model.db.session.commit()
+        return teacher.id, student.id, course.id
+
+def login(client, email):
+    return client.post('/api/sessions', json={'email': email, 'password': 'pw'}).get_json()['id']
+
+question_rqs = [
+    {'type': 'multiple_choice', 'correct_answer': 1, 'variants': ['a', 'b', 'c']},
+    {'type': 'multiple_select', 'variants': [{'text': 'a', 'correct': True}, {'text': 'b', 'correct': False}]},
+    {'type': 'free_response', 'correct_answer': '42', 'checker': 'exact_match'},
+]
+
+def module_rqs(n):
+    ret = []
+    for i in range(n):
+        kind = i % 4
+        if kind == 0:
+            ret.append({'title': f'text {i}', 'type': 'text', 'text': 'lorem ipsum ' * 20, 'question': None})
+        elif kind == 1:
+            ret.append({'title': f'visual {i}', 'type': 'visual'})
+        elif kind == 2:
+            ret.append({'title': f'question {i}', 'type': 'text', 'text': 'lorem ipsum', 'question': question_rqs[i % 3]})
+        else:
+            ret.append({'title': f'test block {i}', 'type': 'test_block', 'test_block_modules': [
+                {'title': f'test {i}.{j}', 'type': 'text', 'text': 'lorem ipsum', 'question': q}
+                for j, q in enumerate(question_rqs)
+            ]})
+    return ret
+
+def lecture_rq(course_id, n):
+    return {'title': f'Lecture of {n} modules', 'course_id': course_id, 'modules': module_rqs(n)}
+
+
+class Timer(object):
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.elapsed = time.perf_counter() - self.start
+
+def best_of(fn, repeat=5, number=1):
+    ret = float('inf')
+    for i in range(repeat):
+        with Timer() as t:
+            for j in range(number):
+                fn()
+        ret = min(ret, t.elapsed / number)
+    return ret
+
+def broadcast(lags, done, tick=0.01):
+    # Stands in for a live lecture: emits on a fixed tick and records how
+    # late each tick fires.
+    expected = time.perf_counter() + tick
+    while not done:
+        eventlet.sleep(max(0, expected - time.perf_counter()))
+        now = time.perf_counter()
+        lags.append(now - expected)
+        api.socketio.emit('tick', {}, room='bench')
+        expected = max(expected + tick, now)
+
+def percentiles(lags):
+    lags = sorted(lags)
+    return lags[len(lags) * 99 // 100], lags[-1]
@@ -0,0 +1,55 @@
+from . import common
+from app import model, workers
+
+from werkzeug.security import generate_password_hash
+import eventlet
+import sys
+
+
+def make_admin(app):
+    with app.app_context():
+        model.db.session.add(model.User(first_name='A', last_name='A', middle_name='A', university='', university_group='', email='admin@bench', password='pw', admin=True))
+        model.db.session.commit()
+
+def make_users(app, n):
+    password_hash = generate_password_hash('pw')
+    with app.app_context():
+        model.db.session.execute(model.User.__table__.insert(), [
+            {'first_name': 'U', 'last_name': 'U', 'middle_name': 'U', 'university': '', 'university_group': '', 'email': f'user{i}@bench', 'password': password_hash, 'session_generation': 0}
+            for i in range(n)
+        ])
+        model.db.session.commit()
+
+def run(app, token, requests, concurrency, pool_size):
+    workers.database.configure(pool_size, app.config['DB_THREADPOOL_QUEUE'], green=True)
+    lags = []
+    done = []
+    ticker = eventlet.spawn(common.broadcast, lags, done)
+    remaining = iter(range(requests))
+    def list_users():
+        client = app.test_client()
+        for i in remaining:
+            rs = client.get('/api/users?pagesize=10', headers={'Authorization': token})
+            assert rs.status_code == 200
+    with common.Timer() as t:
+        pool = eventlet.GreenPool(concurrency)
+        for i in range(concurrency):
+            pool.spawn(list_users)
+        pool.waitall()
+    done.append(True)
+    ticker.wait()
+    return (requests / t.elapsed,) + common.percentiles(lags)
+
+def main(users=200000, requests=500, concurrency=4):
+    # Counts are not cached, so every listing scans the users table.
+    app = common.make_app(PAGINATION_TOTAL_TTL=0)
+    make_admin(app)
+    make_users(app, users)
+    token = common.login(app.test_client(), 'admin@bench')
+    print(f'{"pool":>6} {"requests/s":>12} {"p99 lag":>10} {"max lag":>10}')
+    for pool_size in (0, 1, 4):
+        throughput, p99, worst = run(app, token, requests, concurrency, pool_size)
+        print(f'{pool_size or "off":>6} {throughput:>12.1f} {p99 * 1000:>8.1f}ms {worst * 1000:>8.1f}ms')
+
+if __name__ == '__main__':
+    main(*(int(i) for i in sys.argv[1:]))
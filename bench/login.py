@@ -0,0 +1,44 @@
+from . import common
+from app import model, workers
+
+from werkzeug.security import generate_password_hash
+import eventlet
+import sys
+
+
+def make_students(app, n):
+    password_hash = generate_password_hash('pw')
+    with app.app_context():
+        model.db.session.add_all(model.User(first_name='S', last_name='S', middle_name='S', university='', university_group='', email=f'student{i}@bench', password_hash=password_hash) for i in range(n))
+        model.db.session.commit()
+
+def run(app, n, concurrency, pool_size):
+    workers.passwords.configure(pool_size, app.config['PASSWORD_POOL_QUEUE'], green=True)
+    lags = []
+    done = []
+    ticker = eventlet.spawn(common.broadcast, lags, done)
+    emails = iter(range(n))
+    def login_all():
+        client = app.test_client()
+        for i in emails:
+            rs = client.post('/api/sessions', json={'email': f'student{i}@bench', 'password': 'pw'})
+            assert rs.status_code == 200
+    with common.Timer() as t:
+        pool = eventlet.GreenPool(concurrency)
+        for i in range(concurrency):
+            pool.spawn(login_all)
+        pool.waitall()
+    done.append(True)
+    ticker.wait()
+    return (n / t.elapsed,) + common.percentiles(lags)
+
+def main(n=100, concurrency=20):
+    app = common.make_app()
+    make_students(app, n)
+    print(f'{"pool":>6} {"logins/s":>10} {"p99 lag":>10} {"max lag":>10}')
+    for pool_size in (0, 1, 4, 8):
+        throughput, p99, worst = run(app, n, concurrency, pool_size)
+        print(f'{pool_size or "inline":>6} {throughput:>10.1f} {p99 * 1000:>8.1f}ms {worst * 1000:>8.1f}ms')
+
+if __name__ == '__main__':
+    main(*(int(i) for i in sys.argv[1:]))
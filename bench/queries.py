@@ -0,0 +1,32 @@
+from . import common
+from app import model
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+import sys
+
+
+def main(sizes=(10, 50, 200)):
+    app = common.make_app()
+    teacher_id, student_id, course_id = common.make_users(app)
+    client = app.test_client()
+    token = common.login(client, 'teacher@bench')
+    statements = []
+    # Counts the writer and the read-only engines alike.
+    event.listen(Engine, 'before_cursor_execute', lambda *args: statements.append(args[2]))
+
+    routes = ['/lectures/{}', '/lectures/{}/student', '/users/self/modules?pagesize=100']
+    print(f'{"modules":>8} ' + ' '.join(f'{r:>34}' for r in routes))
+    for n in sizes:
+        client.post('/api/lectures', json=common.lecture_rq(course_id, n), headers={'Authorization': token})
+        with app.app_context():
+            lecture_id = model.Lecture.query.order_by(model.Lecture.id.desc()).first().id
+        counts = []
+        for r in routes:
+            del statements[:]
+            client.get('/api' + r.format(lecture_id), headers={'Authorization': token})
+            counts.append(len(statements))
+        print(f'{n:>8} ' + ' '.join(f'{c:>34}' for c in counts))
+
+if __name__ == '__main__':
+    main(tuple(int(i) for i in sys.argv[1:]) or (10, 50, 200))
@@ -0,0 +1,26 @@
+from . import common
+from app import api, model, resources
+
+import sys
+
+
+def main(sizes=(10, 50, 200)):
+    app = common.make_app()
+    teacher_id, student_id, course_id = common.make_users(app)
+    client = app.test_client()
+    token = common.login(client, 'teacher@bench')
+    for n in sizes:
+        client.post('/api/lectures', json=common.lecture_rq(course_id, n), headers={'Authorization': token})
+
+    includes = api.get_lectures_id_includes
+    print(f'{"modules":>8} {"interpreted":>12} {"compiled":>12} {"speedup":>8}')
+    with app.app_context():
+        for l in model.Lecture.query.options(*resources.lecture.eager(includes)).order_by(model.Lecture.id):
+            expected = resources.lecture.interpret(l, includes)
+            assert resources.lecture.to_json(l, includes) == expected
+            interpreted = common.best_of(lambda: resources.lecture.interpret(l, includes), number=10)
+            compiled = common.best_of(lambda: resources.lecture.to_json(l, includes), number=10)
+            print(f'{len(l.modules):>8} {interpreted * 1000:>10.2f}ms {compiled * 1000:>10.2f}ms {interpreted / compiled:>7.1f}x')
+
+if __name__ == '__main__':
+    main(tuple(int(i) for i in sys.argv[1:]) or (10, 50, 200))
@@ -0,0 +1,19 @@
+from . import common
+from app import api, resources
+
+import sys
+
+
+def main(sizes=(10, 50, 200)):
+    validator = resources.schema_validator(resources.lecture.schema(api.post_lectures_includes))
+    checker = resources.schema_checker(resources.lecture.schema(api.post_lectures_includes))
+    print(f'{"modules":>8} {"jsonschema":>12} {"generated":>12} {"speedup":>8}')
+    for n in sizes:
+        rq = common.lecture_rq(1, n)
+        assert validator.is_valid(rq) and checker(rq)
+        slow = common.best_of(lambda: validator.is_valid(rq), number=3)
+        fast = common.best_of(lambda: checker(rq), number=3)
+        print(f'{n:>8} {slow * 1000:>10.2f}ms {fast * 1000:>10.2f}ms {slow / fast:>7.1f}x')
+
+if __name__ == '__main__':
+    main(tuple(int(i) for i in sys.argv[1:]) or (10, 50, 200))